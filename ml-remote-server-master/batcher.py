@@ -0,0 +1,104 @@
+import unreal_engine as ue
+import upythread_server as ut
+from threading import Timer, Lock
+import traceback
+
+#coalesces inputs that arrive close together into a single call of a batch handler
+#handler receives a list of inputs and must return a list of results in the same order
+class RequestBatcher():
+
+	def __init__(self, handler, max_wait_ms=5, max_batch=8):
+		self.handler = handler
+		self.max_wait = max_wait_ms / 1000.0
+		self.max_batch = max_batch
+		self.pending = []
+		self.timer = None
+		self.lock = Lock()
+
+		#counters
+		self.batches = 0
+		self.requests = 0
+
+	#queue an input, the callback receives its own result once the batch has run
+	def submit(self, input_params, callback=None, priority=0, request_id=None, sid=None):
+		batch = None
+		with self.lock:
+			self.pending.append((input_params, callback, priority, request_id, sid))
+			if len(self.pending) >= self.max_batch:
+				batch = self._take()
+			elif self.timer == None:
+				self.timer = Timer(self.max_wait, self.flush)
+				self.timer.daemon = True
+				self.timer.start()
+
+		if batch:
+			self._dispatch(batch)
+
+	#dispatch whatever is pending right now
+	def flush(self):
+		with self.lock:
+			batch = self._take()
+		if batch:
+			self._dispatch(batch)
+
+	#remove pending inputs matching a predicate and resolve them as cancelled
+	def _remove(self, predicate):
+		with self.lock:
+			removed = [entry for entry in self.pending if predicate(entry)]
+			self.pending = [entry for entry in self.pending if not predicate(entry)]
+		for entry in removed:
+			if entry[1]:
+				ue.run_on_gt(entry[1], {'cancelled': True})
+		return len(removed)
+
+	def cancel(self, request_id, sid=None):
+		return self._remove(lambda entry: entry[3] == request_id and entry[4] == sid)
+
+	def drop_client(self, sid):
+		return self._remove(lambda entry: entry[4] == sid)
+
+	def _take(self):
+		if self.timer != None:
+			self.timer.cancel()
+			self.timer = None
+		batch = self.pending
+		self.pending = []
+		return batch
+
+	def _dispatch(self, batch):
+		#called from the socket.io loop and from timer threads
+		with self.lock:
+			self.batches += 1
+			self.requests += len(batch)
+		#the batch runs as soon as its most urgent input would
+		priority = min(entry[2] for entry in batch)
+		if not ut.run_on_bt(self._run_batch, batch, None, priority):
+			for input_params, callback, *_ in batch:
+				if callback:
+					ue.run_on_gt(callback, {'error': 'server busy, request rejected'})
+
+	#runs on a background worker
+	def _run_batch(self, batch):
+		try:
+			results = list(self.handler([entry[0] for entry in batch]))
+		except BaseException as e:
+			print(traceback.format_exc())
+			results = [{'error': str(e)}] * len(batch)
+
+		#every caller waits for its own result, so a short or long result list fails the whole batch
+		if len(results) != len(batch):
+			error = 'batch handler returned ' + str(len(results)) + ' results for ' + str(len(batch)) + ' inputs'
+			print(error)
+			results = [{'error': error}] * len(batch)
+
+		for (input_params, callback, *_), result in zip(batch, results):
+			if callback:
+				ue.run_on_gt(callback, result)
+
+	def stats(self):
+		with self.lock:
+			return {
+				'batches': self.batches,
+				'requests': self.requests,
+				'mean_batch': self.requests / self.batches if self.batches > 0 else 0.0
+			}
@@ -1,9 +1,12 @@
 import importlib
+import inspect
+import functools
 from mlpluginapi import MLPluginAPI
 from threading import Timer
 import traceback
 import unreal_engine as ue
 import upythread_server as ut
+from batcher import RequestBatcher
 
 #Script data
 active_script = None
@@ -12,11 +15,18 @@ mlobject = None
 script_folder = 'scripts'
 USE_MULTITHREADING = True
 
+#opt-in micro-batching of json inputs via on_json_input_batch
+USE_BATCHING = False
+BATCH_MAX_WAIT_MS = 5		#hold requests at most this long
+BATCH_MAX_SIZE = 8			#or until this many are queued
+batcher = None
+
 #load script into memory. Ready to call begin_play/setup().
 def load(script_name):
 	global active_script
 	global active_script_name
 	global mlobject
+	global batcher
 
 	if(active_script_name != script_name):
 		del active_script
@@ -36,6 +46,7 @@ def load(script_name):
 	try:
 		mlobject = active_script.get_api()
 		if issubclass(mlobject.__class__, MLPluginAPI):
+			batcher = RequestBatcher(mlobject.on_json_input_batch, BATCH_MAX_WAIT_MS, BATCH_MAX_SIZE)
 			status_msg = 'valid script loaded'
 			return status_msg, None #its valid reverse tuple
 		else:
@@ -72,14 +83,15 @@ def begin_play():
 
 
 #wrap a function call with checks and local options
-def call_with_checks(function, input_params=None, callback=None):
+#threaded calls are queued on the worker scheduler by priority (lower runs first)
+def call_with_checks(function, input_params=None, callback=None, priority=0, request_id=None, sid=None):
 	#capture any errors
 	try:
 		#ensure we call only when we have a valid mlobject (loaded script)
 		if(mlobject != None):
 			#swap between threaded operation
 			if(USE_MULTITHREADING):
-				ut.run_on_bt(function, input_params, callback)
+				ut.run_on_bt(function, input_params, callback, priority, request_id, sid)
 			else:
 				if(input_params == None):
 					return function(None, callback)
@@ -87,7 +99,11 @@ def call_with_checks(function, input_params=None, callback=None):
 					return function(input_params, callback)
 	except BaseException as e:
 			error_stack = traceback.format_exc()
-			ue.log(error_s)
+			ue.log(error_stack)
+
+			#the action was never queued, don't leave the caller waiting on it
+			if(USE_MULTITHREADING and callback != None):
+				callback({'error': str(e)})
 
 #def input_callback(input):
 	
@@ -101,18 +117,48 @@ def stop_training():
 		mlobject._stop_training()
 
 #run inputs on our class
-def json_input(input_params, callback=None):
-	call_with_checks(mlobject.on_json_input, input_params, callback)
+def json_input(input_params, callback=None, priority=0, request_id=None, sid=None):
+	if(USE_BATCHING and USE_MULTITHREADING and mlobject != None):
+		batcher.submit(input_params, callback, priority, request_id, sid)
+	else:
+		call_with_checks(mlobject.on_json_input, input_params, callback, priority, request_id, sid)
+
+#cancel a queued request, returns the number of requests removed
+def cancel(request_id, sid=None):
+	removed = ut.get_pool().cancel(request_id, sid)
+	if(batcher != None):
+		removed += batcher.cancel(request_id, sid)
+	return removed
+
+#drop all queued requests of a disconnected client
+def drop_client(sid):
+	removed = ut.get_pool().drop_client(sid)
+	if(batcher != None):
+		removed += batcher.drop_client(sid)
+	return removed
+
+#key identifying duplicate json inputs, None if the script doesn't deduplicate
+def request_key(input_params):
+	if(mlobject == None):
+		return None
+	try:
+		return mlobject.request_key(input_params)
+	except BaseException as e:
+		print(traceback.format_exc())
+		return None
 
-def float_input(input_params, callback=None):
-	call_with_checks(mlobject.on_float_array_input, input_params, callback)
+def float_input(input_params, callback=None, priority=0, request_id=None, sid=None):
+	call_with_checks(mlobject.on_float_array_input, input_params, callback, priority, request_id, sid)
 		
-def custom_function(name, param, callback=None):
+def custom_function(name, param, callback=None, priority=0, request_id=None, sid=None):
 	if(mlobject != None):
 		#check for valid method first
 		method_to_call = getattr(mlobject, name)
 		if(method_to_call):
-			return call_with_checks(method_to_call, param, callback)
+			#methods with a sid argument are told which client called them
+			if('sid' in inspect.signature(method_to_call).parameters):
+				method_to_call = functools.partial(method_to_call, sid=sid)
+			return call_with_checks(method_to_call, param, callback, priority, request_id, sid)
 		else:
 			return None, "No such function" + str(name)
 		
\ No newline at end of file
@@ -64,6 +64,16 @@ class MLPluginAPI():
 
 		return result
 
+	#optional api: return a hashable key for a json input, identical in-flight inputs
+	#with the same key are only run once and share the result. None disables this
+	def request_key(self, json_input):
+		return None
+
+	#optional api: a batch of json inputs that arrived together (see mlplugin.USE_BATCHING)
+	#return one result per input, in the same order
+	def on_json_input_batch(self, json_inputs):
+		return [self.on_json_input(json_input) for json_input in json_inputs]
+
 	#expected optional api: expects float array passed in and returned
 	def on_float_array_input(self, float_array_input):
 		
@@ -0,0 +1,45 @@
+#encoding of array results returned to UE4 via sendInput
+#
+#json:    arrays become plain lists of floats (fallback, slowest)
+#float32: raw little-endian float32 buffer
+#uint16:  little-endian uint16 quantized buffer, value = q * scale + offset
+#
+#binary modes return {'header':{...}, 'data':bytes}, the bytes are sent as a socket.io binary attachment
+
+ENCODINGS = ('json', 'float32', 'uint16')
+
+def is_array(value):
+	return hasattr(value, 'tobytes') and hasattr(value, 'shape')
+
+def encode_array(array, encoding='json'):
+	if encoding == 'json':
+		return array.tolist()
+
+	header = {'shape': list(array.shape), 'byteorder': 'little'}
+
+	if encoding == 'float32':
+		header['dtype'] = 'float32'
+		return {'header': header, 'data': array.astype('<f4').tobytes()}
+
+	if encoding == 'uint16':
+		offset = float(array.min())
+		scale = (float(array.max()) - offset) / 65535.0
+		if scale == 0.0:
+			scale = 1.0
+		header['dtype'] = 'uint16'
+		header['scale'] = scale
+		header['offset'] = offset
+		quantized = ((array - offset) / scale).round().clip(0, 65535).astype('<u2')
+		return {'header': header, 'data': quantized.tobytes()}
+
+	raise ValueError('Unknown payload encoding: ' + str(encoding))
+
+#encode any arrays in a script result, other values pass through untouched
+def encode_result(result, encoding='json'):
+	if is_array(result):
+		return encode_array(result, encoding)
+	if type(result) is dict:
+		return {key: encode_result(value, encoding) for key, value in result.items()}
+	if type(result) in (list, tuple):
+		return [encode_result(value, encoding) for value in result]
+	return result
@@ -0,0 +1,81 @@
+from threading import Condition
+import itertools
+import heapq
+import numbers
+import queue
+import math
+
+#priorities must be numbers the heap can order, bools are rejected as they are most likely a client error
+def valid_priority(priority):
+	return isinstance(priority, numbers.Real) and not isinstance(priority, bool) and not math.isnan(priority)
+
+#priority queue of background tasks, lowest priority value runs first (e.g. distance to the viewer)
+#queued tasks can be cancelled by request id or dropped for a disconnected client
+class RequestScheduler():
+
+	def __init__(self, maxsize=0):
+		self.maxsize = maxsize
+		self.heap = []
+		self.counter = itertools.count()	#keeps equal priorities in arrival order
+		self.cond = Condition()
+
+		#counters
+		self.cancelled = 0
+		self.dropped = 0
+		self.discarded = 0
+
+	def put(self, task, block=True, priority=0, request_id=None, sid=None):
+		#checked up front, an entry that can't be compared would break the heap for every later task
+		if not valid_priority(priority):
+			raise ValueError('invalid priority: ' + repr(priority))
+		with self.cond:
+			while self.maxsize > 0 and len(self.heap) >= self.maxsize:
+				if not block:
+					raise queue.Full
+				self.cond.wait()
+			heapq.heappush(self.heap, (priority, next(self.counter), request_id, sid, task))
+			self.cond.notify_all()
+
+	def get(self):
+		with self.cond:
+			while len(self.heap) == 0:
+				self.cond.wait()
+			task = heapq.heappop(self.heap)[-1]
+			self.cond.notify_all()
+			return task
+
+	#kept for queue.Queue compatibility
+	def task_done(self):
+		pass
+
+	def qsize(self):
+		with self.cond:
+			return len(self.heap)
+
+	#remove queued entries matching a predicate, returns their tasks
+	def _remove(self, predicate):
+		with self.cond:
+			removed = [entry[-1] for entry in self.heap if predicate(entry)]
+			if len(removed) > 0:
+				self.heap = [entry for entry in self.heap if not predicate(entry)]
+				heapq.heapify(self.heap)
+				self.cond.notify_all()
+			return removed
+
+	#cancel a queued request, only the client that sent it can cancel it
+	def cancel(self, request_id, sid=None):
+		removed = self._remove(lambda entry: entry[2] == request_id and entry[3] == sid)
+		self.cancelled += len(removed)
+		return removed
+
+	#remove queued work the server itself no longer needs (e.g. stale prefetches), counted apart from cancels
+	def discard(self, request_id, sid=None):
+		removed = self._remove(lambda entry: entry[2] == request_id and entry[3] == sid)
+		self.discarded += len(removed)
+		return removed
+
+	#drop every queued request of a client
+	def drop_client(self, sid):
+		removed = self._remove(lambda entry: entry[3] == sid)
+		self.dropped += len(removed)
+		return removed
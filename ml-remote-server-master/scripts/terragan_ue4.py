@@ -3,36 +3,287 @@ import numpy as np
 import \
     unreal_engine as ue  # for remote logging only, this is a proxy import to enable same functionality as local variants
 from mlpluginapi import MLPluginAPI
+import upythread_server as ut
+import payload
 
 from tile_generator import *
+from tile_workers import *
+from tile_pipeline import *
+from latent_source import *
+from cube_sphere import *
+
+# Compile the generator forward passes with XLA
+USE_XLA = False
+
+# Serve inference-only generators with EqualizeLearningRate and PixelNormalization fused
+USE_FUSED = True
+
+# Generate tiles in this many separate worker processes (0 generates in the server process)
+USE_WORKER_PROCESSES = 0
+
+# Overlap gen_a and gen_b of different requests in a two-stage pipeline (in-process generation only)
+USE_PIPELINE = False
+PIPELINE_WORKERS = (1, 1)   # gen_a, gen_b stage threads
+
+# Progressive LOD: 'progressive' requests get a coarse 'tilePreview' custom event before the full tile,
+# 'lod': 'preview' requests only get the coarse tile and never run gen_b (in-process generation only).
+# Needs the saved checkpoint of the block before the split, see TileGenerator(preview=True)
+USE_PREVIEW = False
+
+# Distant tiles come from generators stopped at an earlier block, each level halves the tile resolution.
+# A request picks its level with an integer 'lod', or with its 'distance' in tiles: level k from
+# LOD_DISTANCES[k - 1] on (in-process generation only). Every level loads the checkpoint of its
+# last block, so levels are only enabled for sessions that saved them
+LOD_LEVELS = 0
+LOD_DISTANCES = (8, 16)
+
+# Keep finished tiles in an on-disk store of this many bytes per render level, so they survive restarts.
+# Every level preallocates its full size (not sparse on NTFS), e.g. 512 * 2 ** 20
+# (in-process generation only, 0 disables it)
+STORE_BYTES = 0
+
+# Requests without 'latents' get latents hashed from their tile coordinates and the world seed
+# (an optional 'seed' in the request overrides WORLD_SEED)
+WORLD_SEED = 0
+
+# Requests without 'tile_ids' only carry the center tile as scalar 'face', 'x', 'y', the server fills in
+# the 3x3 neighbourhood coordinates, tile ids and rotations from the cube-sphere topology, which is built
+# once at setup (an optional 'tiles_per_face' in the request must match TILES_PER_FACE)
+TILES_PER_FACE = 64
+
+# Warm the tile caches around the predicted viewer position (see viewerMoved)
+USE_PREFETCH = False
+PREFETCH_PRIORITY = float('inf')    # only runs once no real request is queued
+PREFETCH_ID = 'prefetch'
 
 
 class TerraGANAPI(MLPluginAPI):
 
     def on_setup(self):
-        self.tg = TileGenerator('pgf6', 2, overlap=4)
-        ue.log('TileGenerator loaded')
+        generator_kwargs = dict(overlap=4, jit_compile=USE_XLA, fused=USE_FUSED)
 
-    def on_json_input(self, json_input):
+        if USE_WORKER_PROCESSES > 0:
+            self.tg = None
+            self.workers = TileWorkerPool('pgf6', 2, USE_WORKER_PROCESSES, generator_kwargs)
+            self.latent_size = self.workers.config['latent_size']
+
+            # Enough server threads to keep every worker process busy
+            ut.configure(max_workers=2 * USE_WORKER_PROCESSES)
+            ue.log('TileWorkerPool loaded with ' + str(USE_WORKER_PROCESSES) + ' workers')
+        else:
+            self.workers = None
+            self.tg = TileGenerator('pgf6', 2, prefetch=USE_PREFETCH, preview=USE_PREVIEW,
+                                    lod_levels=LOD_LEVELS, store_bytes=STORE_BYTES, **generator_kwargs)
+            self.latent_size = self.tg.pgg.latent_size
+            ue.log('TileGenerator loaded')
+
+        self.latent_source = LatentSource(self.latent_size, WORLD_SEED)
+        self.topology = CubeSphere(TILES_PER_FACE)
+        self.prefetch_discarded = 0
+
+        self.pipeline = None
+        if USE_PIPELINE and self.tg is not None:
+            self.pipeline = TilePipeline(self.tg, *PIPELINE_WORKERS)
+
+    def resolve_request(self, json_input):
+        # Fill in the neighbourhood of a compact request in place, requests that have one are left alone
+        if 'tile_ids' in json_input:
+            return json_input
+        coords, tile_ids, rotations = self.topology.neighbourhood(json_input['face'], json_input['x'], json_input['y'])
+        json_input['faces'] = coords[:, 0].tolist()
+        json_input['x'] = coords[:, 1].tolist()
+        json_input['y'] = coords[:, 2].tolist()
+        json_input['tile_ids'] = tile_ids.tolist()
+        json_input['rotations'] = rotations.tolist()
+        return json_input
 
-        ue.log('Generating tile '
-               + str(json_input['faces'][4]) + ' '
-               + str(json_input['x'][4]) + ' '
-               + str(json_input['y'][4]))
+    def parse_request(self, json_input):
+        name = (str(json_input['faces'][4]) + ' '
+                + str(json_input['x'][4]) + ' '
+                + str(json_input['y'][4]))
         tile_ids = np.asarray(json_input['tile_ids'])
         rotations = np.asarray(json_input['rotations'])
-        latents = np.asarray(json_input['latents']).reshape((9, self.tg.pgg.latent_size))
+        return self.request_latents(json_input), tile_ids, rotations, name
 
-        tile_out = self.tg.generate_tile(latents, tile_ids, rotations,
-                                         str(json_input['faces'][4]) + ' '
-                                         + str(json_input['x'][4]) + ' '
-                                         + str(json_input['y'][4]))
+    def request_latents(self, json_input):
+        # Latents sent by the client, or derived on the server from the 3x3 tile coordinates
+        if 'latents' in json_input:
+            return np.asarray(json_input['latents']).reshape((9, self.latent_size))
+        return coordinate_latents(json_input['faces'], json_input['x'], json_input['y'],
+                                  self.latent_size, json_input.get('seed', self.latent_source.seed))
 
+    def tile_result(self, tile_out):
         tile_out = tile_out[:, :, 0].flatten()
         ue.log(str(np.amin(tile_out)) + ' ' + str(np.amax(tile_out)))
-        ue.log('Tile generated')
 
-        return {'tile_out': list(tile_out)}
+        # Returned as an array so server.send_input can encode it as json or a binary attachment
+        return {'tile_out': tile_out, 'resolution': int(np.sqrt(tile_out.shape[0]))}
+
+    def request_key(self, json_input):
+        # Identical in-flight tile requests are generated once (see server.send_input), invalid ones get an error
+        try:
+            self.check_request(json_input)
+        except ValueError:
+            return None
+        self.resolve_request(json_input)
+        return (json_input.get('tiles_per_face', TILES_PER_FACE),
+                json_input['faces'][4],
+                json_input['x'][4],
+                json_input['y'][4],
+                array_digest(np.asarray(json_input['latents'])) if 'latents' in json_input
+                else json_input.get('seed', self.latent_source.seed),
+                tuple(json_input['rotations']),
+                json_input.get('lod', 'full'),
+                self.request_lod(json_input),
+                json_input.get('progressive', False))
+
+    def request_lod(self, json_input):
+        # Render level of a request, TileGenerator clamps it to the levels it has built
+        lod = json_input.get('lod', 'full')
+        if isinstance(lod, (int, float)) and not isinstance(lod, bool) and float(lod).is_integer() and lod >= 0:
+            return int(lod)
+        if lod not in ('full', 'preview'):
+            raise ValueError("lod must be a level >= 0, 'full' or 'preview', not {!r}".format(lod))
+        if 'distance' in json_input:
+            distance = json_input['distance']
+            if not isinstance(distance, (int, float)) or isinstance(distance, bool) or np.isnan(distance):
+                raise ValueError('distance must be a number, not {!r}'.format(distance))
+            return sum(distance >= lod_distance for lod_distance in LOD_DISTANCES)
+        return 0
+
+    def on_json_input(self, json_input):
+        return self.on_json_input_batch([json_input])[0]
+
+    def check_request(self, json_input):
+        # Raise a ValueError for a request that can't be served
+        self.request_lod(json_input)
+        if 'tile_ids' not in json_input:
+            if json_input.get('tiles_per_face', TILES_PER_FACE) != TILES_PER_FACE:
+                raise ValueError('tiles_per_face must be {}'.format(TILES_PER_FACE))
+            coord = [json_input.get(name) for name in ('face', 'x', 'y')]
+            if not all(isinstance(c, int) and not isinstance(c, bool) for c in coord) \
+                    or not self.topology.contains(*coord):
+                raise ValueError('no tile at face, x, y = {}'.format(coord))
+
+    def on_json_input_batch(self, json_inputs):
+
+        # Invalid requests get an error result, the others are generated together
+        results = [None] * len(json_inputs)
+        valid = []
+        for n, json_input in enumerate(json_inputs):
+            try:
+                self.check_request(json_input)
+                valid.append(n)
+            except ValueError as e:
+                results[n] = {'error': str(e)}
+
+        if valid:
+            for n, result in zip(valid, self.generate_batch([json_inputs[n] for n in valid])):
+                results[n] = result
+        return results
+
+    def generate_batch(self, json_inputs):
+
+        json_inputs = [self.resolve_request(json_input) for json_input in json_inputs]
+        requests = [self.parse_request(json_input) for json_input in json_inputs]
+        if self.tg is not None:
+            for json_input, request in zip(json_inputs, requests):
+                self.tg.remember(list(zip(json_input['faces'], json_input['x'], json_input['y'])), request)
+        ue.log('Generating tiles ' + ', '.join(request[3] for request in requests))
+
+        # Tiles requested together share a single gen_a and gen_b batch, requests that only want a
+        # preview are answered from the preview head and progressive ones get theirs sent ahead
+        preview_only = [json_input.get('lod', 'full') == 'preview' for json_input in json_inputs]
+        progressive = [json_input.get('progressive', False) for json_input in json_inputs]
+        lods = [self.request_lod(json_input) for json_input in json_inputs]
+        results = [None] * len(requests)
+        if self.tg is not None and self.tg.preview_head is not None and any(preview_only + progressive):
+            self.generate_previews(json_inputs, requests, preview_only, progressive, results)
+
+        # Full tiles go through the tile store like any other request
+        full = [r for r in range(len(requests)) if results[r] is None]
+        if full:
+            for r, tile_out in zip(full, self.generate_full([requests[r] for r in full], [lods[r] for r in full])):
+                results[r] = self.tile_result(tile_out)
+        ue.log('Tiles generated')
+
+        return results
+
+    def generate_full(self, requests, lods):
+        if self.tg is not None and any(lods):
+            return self.tg.generate_tiles(requests, lods=lods)
+        elif self.workers is not None:
+            return self.workers.generate_tiles(requests)
+        elif self.pipeline is not None:
+            return self.pipeline.generate_tiles(requests)
+        else:
+            return self.tg.generate_tiles(requests)
+
+    def generate_previews(self, json_inputs, requests, preview_only, progressive, results):
+
+        # gen_a stage and the cheap preview head for the requests that want a preview, their gen_a
+        # tiles stay cached for the full tiles rendered afterwards
+        wanted = [r for r in range(len(requests)) if preview_only[r] or progressive[r]]
+        windows = self.tg.latent_windows([requests[r] for r in wanted])
+        previews = self.tg.preview_tiles([requests[r] for r in wanted], windows)
+
+        # Preview-only requests are done, progressive ones get the coarse tile emitted right away and
+        # the full tile follows as the normal response
+        for r, preview in zip(wanted, previews):
+            if preview_only[r]:
+                results[r] = self.tile_result(preview)
+            else:
+                event = {'faces': json_inputs[r]['faces'][4],
+                         'x': json_inputs[r]['x'][4],
+                         'y': json_inputs[r]['y'][4]}
+                event.update(payload.encode_result(self.tile_result(preview), json_inputs[r].get('encoding', 'json')))
+                self.call_event('tilePreview', event, True)
+
+    def viewerMoved(self, params, sid=None):
+        # Custom function: params has the viewer's 'face', 'x', 'y' (in tiles), 'vx', 'vy' (tiles/s)
+        # and an optional 'lookahead' (s). Schedules low priority cache warming of the predicted ring.
+        # A client whose requests carry no 'latents' sets 'server_latents' (and its 'seed', if any) so
+        # that any tile of the ring can be generated, otherwise only tiles it requested before are warmed.
+        # Prefetches are queued under the client's sid, so each client only replaces its own.
+        if not USE_PREFETCH or self.tg is None:
+            return {}
+
+        # Whatever was predicted for this client's older position is stale now
+        self.prefetch_discarded += ut.get_pool().discard(PREFETCH_ID, sid)
+
+        ring = self.tg.predict_ring(params['face'],
+                                    (params['x'], params['y']),
+                                    (params.get('vx', 0.0), params.get('vy', 0.0)),
+                                    params.get('lookahead', 1.0))
+        latent_seed = params.get('seed', self.latent_source.seed) if params.get('server_latents', False) else None
+        for coord in ring:
+            ut.run_on_bt(self.prefetch_tile, (coord, latent_seed), None, PREFETCH_PRIORITY, PREFETCH_ID, sid)
+
+        return {'prefetching': len(ring),
+                'prefetch_stats': dict(self.tg.prefetch_stats(), discarded=self.prefetch_discarded)}
+
+    def prefetch_tile(self, args):
+        # Clients using server-side latents can have any tile prefetched, otherwise only tiles seen before
+        coord, latent_seed = args
+        if latent_seed is None:
+            self.tg.prefetch_tile(coord)
+        elif self.topology.contains(*coord):
+            face, x, y = coord
+            json_input = self.resolve_request({'face': face, 'x': x, 'y': y, 'seed': latent_seed})
+            self.tg.generate_tiles([self.parse_request(json_input)], save_img=False, prefetch=True)
+
+    def pipelineStats(self, params=None):
+        # Custom function: per-stage utilisation of the gen_a/gen_b pipeline, used to tune segment_idx
+        if self.pipeline is None:
+            return {}
+        return self.pipeline.stats()
+
+    def tileStoreStats(self, params=None):
+        # Custom function: hit rates of the on-disk tile stores, flushed to disk on every call
+        if self.tg is None:
+            return {}
+        self.tg.flush()
+        return self.tg.store_stats()
 
     def on_begin_training(self):
         pass
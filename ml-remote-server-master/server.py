@@ -27,7 +27,12 @@ import socketio
 #active machine learning script handler
 import mlplugin as mlp
 import unreal_engine as ue
+import upythread_server as ut
+import payload
 import json
+import math
+from singleflight import SingleFlight
+from scheduler import valid_priority
 
 # create a Socket.IO server
 sio = socketio.AsyncServer() #async_handlers=True
@@ -49,6 +54,12 @@ ue.set_sio_link(sio, app)
 
 inputFieldName = 'inputData'
 functionFieldName = 'targetFunction'
+encodingFieldName = 'encoding'	#optional: json (default), float32 or uint16 for binary array results
+priorityFieldName = 'priority'	#optional: lower runs first, e.g. distance to the viewer
+requestIdFieldName = 'requestId'	#optional: id used by cancelInput
+
+#identical json inputs in flight at the same time share one result
+single_flight = SingleFlight(mlp.cancel)
 
 #connect/disconnect etc
 @sio.on('connect', namespace="/")
@@ -59,6 +70,9 @@ async def connect(sid, data):
 @sio.on('disconnect', namespace="/")
 async def disconnect(sid):
 	print('disconnect', sid)
+	dropped = mlp.drop_client(sid) + single_flight.drop_client(sid)
+	if dropped > 0:
+		print('dropped ' + str(dropped) + ' queued requests of', sid)
 	await sio.emit('chatMessage', str(sid)[0:4] + ' disconnected.')
 
 #main methods
@@ -68,36 +82,68 @@ async def send_input(sid, data):
 
 	global inputFieldName
 	global functionFieldName
+	global encodingFieldName
+	global priorityFieldName
+	global requestIdFieldName
+
+	encoding = data.get(encodingFieldName, 'json')
+	priority = data.get(priorityFieldName, 0)
+	request_id = data.get(requestIdFieldName, None)
+
+	#reject priorities the scheduler can't order before anything is queued
+	if not valid_priority(priority) or math.isinf(priority):
+		return {'error': 'invalid priority: ' + repr(priority)}
 
 	#handle callback and wrap around logs
+	def encoded(resolve):
+		def callback_lambda(params):
+			#print and emit logs
+			#print('sendInput return: ' + str(params))
+			#ue.log(params)
+			#called from a worker thread, encode the result there so large arrays don't block the socket.io loop
+			try:
+				params = payload.encode_result(params, encoding)
+			except BaseException as e:
+				params = {'error': str(e)}
+			resolve(params)
+		return callback_lambda
+
+	#define a future so we can return the callback correctly
 	future = ue.sio_future()
-	def callback_lambda(params):
-		#print and emit logs
-		#print('sendInput return: ' + str(params))
-		#ue.log(params)
-		future.set_result(params)
+	callback_lambda = encoded(lambda params: future.get_loop().call_soon_threadsafe(future.set_result, params))
 
 	#branch targeting for expected functions
 	if data[functionFieldName] == 'on_json_input':
-		#define a future so we can return the callback correctly
 
 		inputData = data[inputFieldName]
 		#json decode string if string passed (possible call not using sio object call)
 		if type(inputData) is str:
 			inputData = json.loads(inputData)
 
-		mlp.json_input(inputData, callback_lambda)
-		return await future
+		#identical inputs of any client share one queued run, see SingleFlight
+		def submit_json_input(callback, priority, request_id, sid):
+			mlp.json_input(inputData, encoded(callback), priority, request_id, sid)
+
+		#results are shared already encoded, so only inputs asking for the same encoding are deduplicated
+		key = mlp.request_key(inputData)
+		if key != None:
+			key = (encoding, key)
+		return await single_flight.run(key, submit_json_input, priority, request_id, sid)
 		
 	elif data[functionFieldName] == 'on_float_array_input':
-		mlp.float_input(data[inputFieldName], callback_lambda)
+		mlp.float_input(data[inputFieldName], callback_lambda, priority, request_id, sid)
 		return await future
 
 	#it's a custom function
 	else:
-		mlp.custom_function(data[functionFieldName], data[inputFieldName], callback_lambda)
+		mlp.custom_function(data[functionFieldName], data[inputFieldName], callback_lambda, priority, request_id, sid)
 		return await future
 
+#cancel a queued sendInput by its requestId, its caller receives {'cancelled': True}
+@sio.on('cancelInput', namespace="/")
+async def cancel_input(sid, request_id):
+	return {'cancelled': mlp.cancel(request_id, sid) + single_flight.cancel(request_id, sid)}
+
 @sio.on('startScript', namespace="/")
 async def start_script(sid, script_name):
 	print('loading <' + script_name + '>')
@@ -156,6 +202,10 @@ async def chat(sid, data):
 		result = await send_input(sid, {functionFieldName:'onJsonInput',inputFieldName:{'a':1,'b':2}})
 		print(result)
 
+	if data[0:2] == '/w':
+		await sio.emit('chatMessage', 'workers: ' + json.dumps(ut.get_pool().stats()))
+		await sio.emit('chatMessage', 'dedup: ' + json.dumps(single_flight.stats()))
+
 	if data[0:2] == '/f':
 		command_array = data[3:].split()
 		function_name = command_array[0]
@@ -0,0 +1,134 @@
+import asyncio
+import itertools
+
+#shared work of one key and the callers waiting for it
+class Flight():
+
+	def __init__(self, request_id, submit):
+		self.request_id = request_id	#the work is queued under this id, with no sid
+		self.submit = submit
+		self.priority = None
+		self.generation = 0				#bumped whenever the work is cancelled or queued again
+		self.waiters = []				#[future, priority, request_id, sid] of every caller
+
+#collapses identical requests that are in flight at the same time into one
+#all calls must come from the socket.io event loop, so no locking is needed
+#callers only detach from the shared work when they cancel or disconnect, the work itself is
+#cancelled once nobody waits for it anymore and otherwise runs at the most urgent waiting priority
+class SingleFlight():
+
+	#cancel_work(request_id, sid) removes queued work and returns how many entries it removed
+	def __init__(self, cancel_work):
+		self.cancel_work = cancel_work
+		self.in_flight = {}
+		self.ids = itertools.count()
+
+		#counters
+		self.requests = 0
+		self.deduplicated = 0
+		self.cancelled = 0
+		self.requeued = 0
+
+	#run submit(callback, priority, request_id, sid) for key, or join the work queued for the same key
+	#submit must queue the work so that callback(result) is called once, from any thread
+	async def run(self, key, submit, priority=0, request_id=None, sid=None):
+		self.requests += 1
+		loop = asyncio.get_event_loop()
+		future = loop.create_future()
+
+		if key == None:
+			submit(lambda result: loop.call_soon_threadsafe(self._resolve, future, result), priority, request_id, sid)
+			return await future
+
+		flight = self.in_flight.get(key)
+		if flight == None:
+			flight = Flight(('singleflight', next(self.ids)), submit)
+			flight.waiters.append([future, priority, request_id, sid])
+			self.in_flight[key] = flight
+			self._submit(key, flight, priority)
+		else:
+			self.deduplicated += 1
+			flight.waiters.append([future, priority, request_id, sid])
+			self._requeue(key, flight)
+
+		return await future
+
+	def _resolve(self, future, result):
+		#the caller may have been resolved as cancelled already
+		if not future.done():
+			future.set_result(result)
+
+	def _submit(self, key, flight, priority):
+		flight.generation += 1
+		flight.priority = priority
+		generation = flight.generation
+		loop = asyncio.get_event_loop()
+		def callback(result):
+			loop.call_soon_threadsafe(self._finish, key, flight, generation, result)
+		try:
+			flight.submit(callback, priority, flight.request_id, None)
+		except BaseException as e:
+			#nothing was queued, fail the waiters instead of leaving the flight stuck
+			flight.generation += 1
+			if self.in_flight.get(key) is flight:
+				del self.in_flight[key]
+			for waiter in flight.waiters:
+				self._resolve(waiter[0], {'error': str(e)})
+
+	def _finish(self, key, flight, generation, result):
+		#results of work that was cancelled or queued again since are stale
+		if generation != flight.generation:
+			return
+		if self.in_flight.get(key) is flight:
+			del self.in_flight[key]
+		for waiter in flight.waiters:
+			self._resolve(waiter[0], result)
+
+	#queue the work again at the most urgent priority of its waiters, unless it has started already
+	def _requeue(self, key, flight):
+		priority = min(waiter[1] for waiter in flight.waiters)
+		if priority == flight.priority:
+			return
+		if self.cancel_work(flight.request_id, None) > 0:
+			self.requeued += 1
+			self._submit(key, flight, priority)
+
+	#resolve the callers matching a predicate as cancelled, returns how many there were
+	def _detach(self, predicate):
+		detached = 0
+		for key, flight in list(self.in_flight.items()):
+			removed = [waiter for waiter in flight.waiters if predicate(waiter)]
+			if len(removed) == 0:
+				continue
+			flight.waiters = [waiter for waiter in flight.waiters if not predicate(waiter)]
+			for waiter in removed:
+				self._resolve(waiter[0], {'cancelled': True})
+			detached += len(removed)
+
+			if len(flight.waiters) > 0:
+				self._requeue(key, flight)
+			elif self.cancel_work(flight.request_id, None) > 0:
+				#nobody waits anymore and the work hasn't started, running work stays joinable
+				flight.generation += 1
+				del self.in_flight[key]
+
+		self.cancelled += detached
+		return detached
+
+	#cancel the caller that sent request_id, other callers of the same work keep waiting
+	def cancel(self, request_id, sid=None):
+		return self._detach(lambda waiter: waiter[2] == request_id and waiter[3] == sid)
+
+	#detach every caller of a disconnected client
+	def drop_client(self, sid):
+		return self._detach(lambda waiter: waiter[3] == sid)
+
+	def stats(self):
+		return {
+			'requests': self.requests,
+			'deduplicated': self.deduplicated,
+			'cancelled': self.cancelled,
+			'requeued': self.requeued,
+			'in_flight': len(self.in_flight),
+			'dedup_rate': self.deduplicated / self.requests if self.requests > 0 else 0.0
+		}
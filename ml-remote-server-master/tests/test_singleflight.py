@@ -0,0 +1,104 @@
+import os
+import sys
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from singleflight import SingleFlight
+
+#stands in for the worker pool: queued work runs when the test says so, cancelling resolves it like the pool does
+class FakeQueue():
+
+	def __init__(self):
+		self.queued = []
+
+	def submit(self, callback, priority, request_id, sid):
+		self.queued.append([callback, priority, request_id, sid])
+
+	def cancel(self, request_id, sid=None):
+		removed = [entry for entry in self.queued if entry[2] == request_id and entry[3] == sid]
+		self.queued = [entry for entry in self.queued if entry not in removed]
+		for entry in removed:
+			entry[0]({'cancelled': True})
+		return len(removed)
+
+	def run_next(self, result):
+		self.queued.pop(0)[0](result)
+
+class SingleFlightTest(unittest.TestCase):
+
+	def test_one_client_cancelling_leaves_the_other_waiting(self):
+		async def scenario():
+			work = FakeQueue()
+			flight = SingleFlight(work.cancel)
+			a = asyncio.ensure_future(flight.run('tile', work.submit, 5, 'ra', 'sid_a'))
+			b = asyncio.ensure_future(flight.run('tile', work.submit, 5, 'rb', 'sid_b'))
+			await asyncio.sleep(0)
+			self.assertEqual(len(work.queued), 1)
+
+			#the leader cancels, the shared work stays queued for the follower
+			self.assertEqual(flight.cancel('ra', 'sid_a'), 1)
+			self.assertEqual(len(work.queued), 1)
+
+			work.run_next('result')
+			return await a, await b
+
+		self.assertEqual(asyncio.run(scenario()), ({'cancelled': True}, 'result'))
+
+	def test_work_is_cancelled_once_nobody_waits(self):
+		async def scenario():
+			work = FakeQueue()
+			flight = SingleFlight(work.cancel)
+			a = asyncio.ensure_future(flight.run('tile', work.submit, 5, 'ra', 'sid_a'))
+			b = asyncio.ensure_future(flight.run('tile', work.submit, 5, 'rb', 'sid_b'))
+			await asyncio.sleep(0)
+
+			flight.drop_client('sid_b')
+			self.assertEqual(len(work.queued), 1)
+			flight.cancel('ra', 'sid_a')
+			self.assertEqual(len(work.queued), 0)
+			self.assertEqual(flight.stats()['in_flight'], 0)
+			return await a, await b
+
+		self.assertEqual(asyncio.run(scenario()), ({'cancelled': True}, {'cancelled': True}))
+
+	def test_urgent_duplicate_requeues_the_work(self):
+		async def scenario():
+			work = FakeQueue()
+			flight = SingleFlight(work.cancel)
+			a = asyncio.ensure_future(flight.run('tile', work.submit, 9, 'ra', 'sid_a'))
+			await asyncio.sleep(0)
+			b = asyncio.ensure_future(flight.run('tile', work.submit, 1, 'rb', 'sid_b'))
+			await asyncio.sleep(0)
+			self.assertEqual([entry[1] for entry in work.queued], [1])
+
+			#back to the leader's priority once the urgent caller is gone
+			flight.cancel('rb', 'sid_b')
+			self.assertEqual([entry[1] for entry in work.queued], [9])
+
+			work.run_next('result')
+			return await a, await b
+
+		self.assertEqual(asyncio.run(scenario()), ('result', {'cancelled': True}))
+
+	def test_failed_submit_doesnt_leave_the_flight_stuck(self):
+		def failing_submit(callback, priority, request_id, sid):
+			raise ValueError('queue broken')
+
+		async def scenario():
+			work = FakeQueue()
+			flight = SingleFlight(work.cancel)
+			failed = await flight.run('tile', failing_submit, 5, 'ra', 'sid_a')
+			self.assertEqual(flight.stats()['in_flight'], 0)
+
+			#the next caller of the same key queues fresh work
+			b = asyncio.ensure_future(flight.run('tile', work.submit, 5, 'rb', 'sid_b'))
+			await asyncio.sleep(0)
+			work.run_next('result')
+			return failed, await b
+
+		self.assertEqual(asyncio.run(scenario()), ({'error': 'queue broken'}, 'result'))
+
+if __name__ == '__main__':
+	unittest.main()
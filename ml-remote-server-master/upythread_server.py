@@ -1,6 +1,15 @@
 import unreal_engine as ue
-from threading import Thread
+from threading import Thread, Lock
+from scheduler import RequestScheduler
+import traceback
 import asyncio
+import queue
+import time
+
+#worker pool settings, see configure()
+MAX_WORKERS = 2			#concurrent background actions, each one uses the full TF intra-op pool
+MAX_QUEUE = 64			#queued actions before rejecting, 0 for unbounded
+BLOCK_WHEN_FULL = False	#block the caller instead of rejecting (note: this stalls the socket.io loop)
 
 #internal, don't call directly
 def backgroundAction(args=None):
@@ -28,7 +37,141 @@ def backgroundAction(args=None):
 		else:
 			ue.run_on_gt(callback)
 
-#run function on a background thread, optional callback when complete on game thread
-def run_on_bt(actionfunction, functionArgs=None, callback=None):
-	t = Thread(target=backgroundAction, args=([actionfunction, functionArgs, callback],))
-	t.start()
\ No newline at end of file
+#fixed number of threads working off a bounded priority queue of background actions
+class WorkerPool():
+
+	def __init__(self, max_workers=MAX_WORKERS, max_queue=MAX_QUEUE, block=BLOCK_WHEN_FULL):
+		self.max_workers = max_workers
+		self.block = block
+		self.tasks = RequestScheduler(max_queue)
+		self.lock = Lock()
+
+		#counters
+		self.submitted = 0
+		self.rejected = 0
+		self.completed = 0
+		self.failed = 0
+		self.max_depth = 0
+		self.total_wait = 0.0
+		self.max_wait = 0.0
+
+		self.workers = []
+		for i in range(max_workers):
+			t = Thread(target=self._work, name='upythread_worker_' + str(i), daemon=True)
+			t.start()
+			self.workers.append(t)
+
+	#queue an action, returns False if the queue is full and we don't block
+	def submit(self, args, priority=0, request_id=None, sid=None):
+		try:
+			self.tasks.put((time.perf_counter(), args), self.block, priority, request_id, sid)
+		except queue.Full:
+			with self.lock:
+				self.rejected += 1
+			return False
+
+		with self.lock:
+			self.submitted += 1
+			self.max_depth = max(self.max_depth, self.tasks.qsize())
+		return True
+
+	def _work(self):
+		while True:
+			#a failure to take a task must not kill the worker
+			try:
+				task = self.tasks.get()
+			except BaseException as e:
+				print(traceback.format_exc())
+				continue
+
+			#sentinel from shutdown()
+			if task == None:
+				self.tasks.task_done()
+				return
+
+			queued_at, args = task
+			wait = time.perf_counter() - queued_at
+			with self.lock:
+				self.total_wait += wait
+				self.max_wait = max(self.max_wait, wait)
+
+			try:
+				backgroundAction(args)
+				with self.lock:
+					self.completed += 1
+			except BaseException as e:
+				with self.lock:
+					self.failed += 1
+				print(traceback.format_exc())
+
+				#don't leave the caller waiting on a result that will never come
+				if len(args) > 2 and args[2]:
+					ue.run_on_gt(args[2], {'error': str(e)})
+			finally:
+				self.tasks.task_done()
+
+	#resolve removed actions so their callers stop waiting
+	def _resolve_cancelled(self, tasks):
+		for queued_at, args in tasks:
+			if len(args) > 2 and args[2]:
+				ue.run_on_gt(args[2], {'cancelled': True})
+		return len(tasks)
+
+	#cancel a queued action, returns the number of actions removed
+	def cancel(self, request_id, sid=None):
+		return self._resolve_cancelled(self.tasks.cancel(request_id, sid))
+
+	#discard queued actions the server no longer needs, returns the number of actions removed
+	def discard(self, request_id, sid=None):
+		return self._resolve_cancelled(self.tasks.discard(request_id, sid))
+
+	#drop all queued actions of a disconnected client
+	def drop_client(self, sid):
+		return self._resolve_cancelled(self.tasks.drop_client(sid))
+
+	#let workers finish queued actions and exit
+	def shutdown(self):
+		for t in self.workers:
+			self.tasks.put(None, priority=float('inf'))
+
+	def stats(self):
+		with self.lock:
+			started = self.completed + self.failed
+			return {
+				'workers': self.max_workers,
+				'queue_depth': self.tasks.qsize(),
+				'max_queue_depth': self.max_depth,
+				'submitted': self.submitted,
+				'rejected': self.rejected,
+				'completed': self.completed,
+				'failed': self.failed,
+				'cancelled': self.tasks.cancelled,
+				'dropped': self.tasks.dropped,
+				'discarded': self.tasks.discarded,
+				'mean_wait': self.total_wait / started if started > 0 else 0.0,
+				'max_wait': self.max_wait
+			}
+
+pool = None
+
+#(re)create the worker pool, queued actions on a previous pool still run
+def configure(max_workers=MAX_WORKERS, max_queue=MAX_QUEUE, block=BLOCK_WHEN_FULL):
+	global pool
+	if pool != None:
+		pool.shutdown()
+	pool = WorkerPool(max_workers, max_queue, block)
+	return pool
+
+def get_pool():
+	if pool == None:
+		configure()
+	return pool
+
+#run function on a background worker, optional callback when complete on game thread
+#lower priority values run first, request_id and sid allow cancelling the queued action
+#returns False if the request was rejected, the callback then receives an error result
+def run_on_bt(actionfunction, functionArgs=None, callback=None, priority=0, request_id=None, sid=None):
+	accepted = get_pool().submit([actionfunction, functionArgs, callback], priority, request_id, sid)
+	if not accepted and callback:
+		ue.run_on_gt(callback, {'error': 'server busy, request rejected'})
+	return accepted
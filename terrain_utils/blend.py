@@ -0,0 +1,74 @@
+import functools
+
+import numpy as np
+
+
+@functools.lru_cache(maxsize=None)
+def weight_mask(res, exponent=1, channels=1, symmetric=True):
+    """
+    Radial blending mask of shape [res, res, channels], highest in the middle of
+    the tile and falling off to 1 in the corners. With symmetric=True the center
+    lies between the middle pixels, so the mask is unchanged by np.rot90;
+    otherwise it lies at pixel (res / 2, res / 2). Masks are memoized and read-only.
+    """
+    center = (res - 1.0) / 2.0 if symmetric else res / 2.0
+    coords = np.arange(res) - center
+    distance = np.sqrt(coords[:, np.newaxis] ** 2 + coords[np.newaxis, :] ** 2)
+    max_weight = np.sqrt(2.0) * center
+
+    mask = ((max_weight - distance) ** exponent + 1).astype(np.float32)
+    mask = np.repeat(mask[:, :, np.newaxis], channels, axis=-1)
+    mask.setflags(write=False)
+    return mask
+
+
+class OverlapAdd(object):
+    """Weighted overlap-add of tiles into a float32 field"""
+
+    def __init__(self, height, width, channels):
+        self.values = np.zeros(shape=(height, width, channels), dtype=np.float32)
+        self.weights = np.zeros(shape=(height, width, 1), dtype=np.float32)
+
+    def add(self, tiles, offsets, mask):
+        # Weight a batch of [n, h, w, c] tiles at once and add each one at its (y, x) offset
+        if len(tiles) == 0:
+            return
+        h, w = mask.shape[:2]
+        weighted = np.asarray(tiles, dtype=np.float32) * mask
+        mask = mask[:, :, :1]
+        for tile, (y, x) in zip(weighted, offsets):
+            self.values[y:y + h, x:x + w] += tile
+            self.weights[y:y + h, x:x + w] += mask
+
+    def add_grid(self, tiles, origin, stride, mask):
+        """
+        Weight a [rows, cols, h, w, c] grid of tiles spaced stride apart, the first one at the
+        (y, x) origin, and add them without a Python loop per tile. Tiles that lie a multiple
+        of ceil(max(h, w) / stride) grid steps apart never overlap, so each such group of tiles
+        is added at once through a strided view of the field.
+        """
+        rows, cols, h, w = tiles.shape[:4]
+        if rows == 0 or cols == 0:
+            return
+        y, x = origin
+        assert y + (rows - 1) * stride + h <= self.values.shape[0] and \
+            x + (cols - 1) * stride + w <= self.values.shape[1], 'tile grid exceeds the field'
+
+        weighted = np.asarray(tiles, dtype=np.float32) * mask
+        mask = mask[:, :, :1]
+        phase = -(-max(h, w) // stride)
+        for a in range(min(phase, rows)):
+            for b in range(min(phase, cols)):
+                group = weighted[a::phase, b::phase]
+                for field, value in ((self.values, group), (self.weights, mask)):
+                    target = field[y + a * stride:, x + b * stride:]
+                    view = np.lib.stride_tricks.as_strided(
+                        target,
+                        shape=group.shape[:2] + (h, w, field.shape[-1]),
+                        strides=(target.strides[0] * stride * phase, target.strides[1] * stride * phase)
+                        + target.strides,
+                        writeable=True)
+                    view += value
+
+    def result(self):
+        return self.values / (self.weights + 1e-8)
@@ -0,0 +1,85 @@
+import numpy as np
+
+# Outward normal N, x direction U and y direction V of every cube face, with U x V = N so that
+# x right and y up is counter-clockwise seen from outside. UE4 has to number its faces the same way.
+FACE_FRAMES = np.array([[[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+                        [[-1, 0, 0], [0, -1, 0], [0, 0, 1]],
+                        [[0, 1, 0], [-1, 0, 0], [0, 0, 1]],
+                        [[0, -1, 0], [1, 0, 0], [0, 0, 1]],
+                        [[0, 0, 1], [0, 1, 0], [-1, 0, 0]],
+                        [[0, 0, -1], [0, 1, 0], [1, 0, 0]]], dtype=np.float64)
+
+
+class CubeSphere(object):
+    """
+    Tile topology of a cube sphere with tiles_per_face x tiles_per_face tiles per face.
+    The 3x3 neighbourhood of a tile lists its neighbours in the slot order of
+    TileGenerator requests: slot (dy + 1) * 3 + (dx + 1) holds the neighbour at (x + dx, y + dy).
+    Neighbours across a face edge are found by folding their position on the unfolded plane
+    over the edge of the cube, their rotation is the number of np.rot90 turns that bring
+    their tile into the orientation of the center tile. Diagonal neighbours beyond a cube
+    corner do not exist and get tile id -1. Tile ids are face * n * n + y * n + x.
+    All neighbourhoods are computed once into lookup tables.
+    """
+
+    def __init__(self, tiles_per_face):
+
+        self.n = n = tiles_per_face
+
+        faces, ys, xs, slots = np.meshgrid(np.arange(6), np.arange(n), np.arange(n), np.arange(9), indexing='ij')
+        nx = xs + slots % 3 - 1
+        ny = ys + slots // 3 - 1
+        out_x = (nx < 0) | (nx >= n)
+        out_y = (ny < 0) | (ny >= n)
+
+        # Position of the neighbour on the plane of the center tile's face, on a cube of side 2
+        normal, u, v = (FACE_FRAMES[faces, i] for i in range(3))
+        a = ((2 * nx + 1) / n - 1)[..., np.newaxis]
+        b = ((2 * ny + 1) / n - 1)[..., np.newaxis]
+        position = normal + u * a + v * b
+
+        # Fold neighbours beyond one edge over onto the face across it
+        edge = np.where(out_x[..., np.newaxis], np.sign(a) * u, np.sign(b) * v)
+        overhang = np.where(out_x, np.abs(a[..., 0]), np.abs(b[..., 0])) - 1
+        crossed = (out_x ^ out_y)[..., np.newaxis]
+        position = np.where(crossed, position - overhang[..., np.newaxis] * (edge + normal), position)
+        neighbour_faces = np.where(crossed[..., 0], np.argmax(edge @ FACE_FRAMES[:, 0].T, axis=-1), faces)
+
+        # Tile coordinates on the neighbour's own face
+        neighbour_u = FACE_FRAMES[neighbour_faces, 1]
+        neighbour_v = FACE_FRAMES[neighbour_faces, 2]
+        neighbour_x = np.rint((np.sum(position * neighbour_u, axis=-1) + 1) * n / 2 - 0.5).astype(np.int64)
+        neighbour_y = np.rint((np.sum(position * neighbour_v, axis=-1) + 1) * n / 2 - 0.5).astype(np.int64)
+
+        # Unfold the neighbour's x direction back onto the center face and read off its angle
+        along_normal = np.sum(neighbour_u * normal, axis=-1, keepdims=True)
+        unfolded = neighbour_u - along_normal * normal - along_normal * edge
+        angle = np.arctan2(np.sum(unfolded * v, axis=-1), np.sum(unfolded * u, axis=-1))
+        rotations = np.where(crossed[..., 0], np.rint(angle / (np.pi / 2)).astype(np.int64) % 4, 0)
+
+        # Nothing lies diagonally beyond a cube corner
+        corner = out_x & out_y
+        self.coords = np.stack([neighbour_faces, neighbour_x, neighbour_y], axis=-1)
+        self.coords[corner] = -1
+        self.tile_ids = np.where(corner, -1, self.tile_id(neighbour_faces, neighbour_x, neighbour_y))
+        self.rotations = np.where(corner, 0, rotations)
+
+    def tile_id(self, faces, xs, ys):
+        return (np.asarray(faces) * self.n + np.asarray(ys)) * self.n + np.asarray(xs)
+
+    def tile_coords(self, tile_ids):
+        faces, rest = np.divmod(np.asarray(tile_ids), self.n * self.n)
+        ys, xs = np.divmod(rest, self.n)
+        return faces, xs, ys
+
+    def contains(self, face, x, y):
+        return 0 <= face < 6 and 0 <= x < self.n and 0 <= y < self.n
+
+    def neighbourhood(self, face, x, y):
+        # [9, 3] (face, x, y) coordinates, [9] tile ids and [9] rotations of the 3x3 neighbourhood of a tile
+        return self.coords[face, y, x], self.tile_ids[face, y, x], self.rotations[face, y, x]
+
+    def neighbourhoods(self, faces, xs, ys):
+        # Neighbourhoods of many tiles at once, e.g. a whole face for bulk generation
+        faces, xs, ys = np.broadcast_arrays(faces, xs, ys)
+        return self.coords[faces, ys, xs], self.tile_ids[faces, ys, xs], self.rotations[faces, ys, xs]
@@ -0,0 +1,44 @@
+from model import *
+
+
+def fuse_weights(model, fused_model):
+    # Copy weights from a training graph into its inference-only copy, baking in the He constant
+    for fused_layer in fused_model.layers:
+        if not fused_layer.weights:
+            continue
+        layer = model.get_layer(fused_layer.name)
+        if isinstance(layer, EqualizeLearningRate):
+            kernel = layer.v.numpy() * layer.he_constant.numpy()
+            fused_layer.set_weights([kernel, layer.layer.bias.numpy()])
+        else:
+            fused_layer.set_weights(layer.get_weights())
+
+
+def check_equivalence(model, fused_model, inputs, atol=1e-4):
+    # Compare both graphs on the same inputs and return the largest absolute difference
+    expected = model(inputs, training=False).numpy()
+    actual = fused_model(inputs, training=False).numpy()
+    error = float(np.amax(np.abs(expected - actual)))
+    if not error <= atol:
+        raise ValueError('fused model deviates from training graph {}: {} > {}'.format(model.name, error, atol))
+    return error
+
+
+def export_inference(pgg, gen_a, gen_b, split_idx, n_check=4, atol=1e-4):
+    """
+    Build inference-only copies of a split generator. Every EqualizeLearningRate
+    layer becomes a plain Conv2D/Dense with the He constant folded into its kernel,
+    and PixelNormalization becomes a single rsqrt-multiply. Both copies are checked
+    against the training graph on n_check random latents.
+    """
+
+    fused_a, fused_b = pgg.build_gen_stable(split_idx, fused=True)
+    fuse_weights(gen_a, fused_a)
+    fuse_weights(gen_b, fused_b)
+
+    if n_check > 0:
+        latents = tf.constant(random_latents(pgg.latent_size, n_check), dtype=tf.float32)
+        check_equivalence(gen_a, fused_a, latents, atol)
+        check_equivalence(gen_b, fused_b, gen_a(latents, training=False), atol)
+
+    return fused_a, fused_b
@@ -0,0 +1,182 @@
+import os
+
+import numpy as np
+
+from util import *
+from latent_manipulation import *
+from latent_grid import *
+from blend import *
+
+
+def merge_halo(field, row, tail, head):
+    # Finish the field rows from row on that two bands both accumulated, from their (values, weights) pairs
+    values = tail[0] + head[0]
+    weights = tail[1] + head[1]
+    field[row:row + values.shape[0]] = values / (weights + 1e-8)
+
+
+class FieldBaker(object):
+    """
+    Out-of-core generation of terrain fields of any size with a TerrainGenerator.
+    The latent field and the output are .npy memmaps in path (np.load them with
+    mmap_mode='r'). The latent field is accumulated one row of gen_a tiles at a
+    time, only a window of tile_res rows of blending accumulators stays in memory and
+    finished rows are written out as the window slides down. gen_b then renders the
+    latent field in halo-padded blocks sized to memory_bytes (see render_region).
+    Arguments:
+      tg: a TerrainGenerator.
+      field_res: height and width of the latent field in latent pixels.
+      latent_rows: latent grid source (see latent_grid.py), by default the
+        coordinate-hashed latents of seed.
+      cropping, overlap: as in TerrainGenerator.random_latent_field, overlap may not
+        exceed the stride between tiles.
+      lm_version, lm_attribute, delta_range: center every latent on the boundary of
+        lm_attribute and move it by a delta that runs from delta_range on the first
+        tile row to -delta_range on the last one (no manipulation without lm_version).
+    """
+
+    def __init__(self, tg, path, field_res, latent_rows=None, seed=0, cropping=0, overlap=0,
+                 lm_version=None, lm_attribute=None, delta_range=4.0, memory_bytes=2 * 2 ** 30):
+
+        self.tg = tg
+        self.path = path
+        self.field_res = field_res
+        self.seed = seed
+        if latent_rows is None:
+            latent_rows = CoordinateLatentGrid(tg.pgg.latent_size, seed)
+        self.latent_rows = latent_rows
+        self.memory_bytes = memory_bytes
+
+        # Tile geometry of the latent field
+        self.cropping = cropping
+        self.overlap = overlap
+        self.output_tile_res = tg.tile_res - 2 * cropping
+        self.stride = self.output_tile_res - overlap
+        assert overlap <= self.stride, 'overlap may not exceed the stride between tiles'
+        self.tiles_per_row = int((field_res - self.output_tile_res + self.stride) / self.stride)
+        self.channels_a = tg.gen_a.outputs[0].shape[-1]
+        self.weight_mask_a = weight_mask(self.output_tile_res, 1, symmetric=False)
+
+        # Latent manipulation
+        self.lm = tg.latent_manipulator(lm_version) if lm_version is not None else None
+        self.lm_attribute = lm_attribute
+        self.delta_range = delta_range
+
+        # Memory use per gen_a tile and per rendered latent pixel, largest activation times a margin for copies
+        activations = [int(np.prod(layer.output.shape[1:])) for layer in tg.gen_b.layers]
+        self.pixel_bytes = 3 * 4 * max(activations) / tg.tile_res ** 2
+        self.batch_a = max(1, int(memory_bytes // (3 * 4 * tg.tile_res ** 2 * self.channels_a)))
+
+        os.makedirs(path, exist_ok=True)
+
+    def open_field(self, name, shape=None):
+        # Create a float32 .npy memmap, or open an existing one for writing without a shape
+        file_name = os.path.join(self.path, name + '.npy')
+        if shape is None:
+            return np.lib.format.open_memmap(file_name, mode='r+')
+        return np.lib.format.open_memmap(file_name, mode='w+', dtype=np.float32, shape=tuple(shape))
+
+    def tile_row(self, i):
+        # gen_a tiles of tile row i, cropped
+        latents = self.latent_rows(i, i + 1, self.tiles_per_row)[0]
+        if self.lm is not None:
+            delta = (i / max(self.tiles_per_row - 1, 1) * 2 - 1) * -self.delta_range
+            latents = self.lm.center_latent(latents, self.lm_attribute)
+            latents = self.lm.move_latent(latents, self.lm_attribute, delta)
+
+        tiles = self.tg.infer_a(latents, batch_size=self.batch_a)
+        if self.cropping > 0:
+            tiles = tiles[:, self.cropping:-self.cropping, self.cropping:-self.cropping]
+        return tiles
+
+    def latent_band(self, field, i0, i1):
+        """
+        Accumulate tile rows i0:i1 into field, writing rows as soon as no later tile row
+        covers them. Rows this band shares with tile rows before i0 and after i1 are not
+        written but returned unnormalized as head and tail (values, weights) pairs.
+        """
+
+        res, stride, overlap = self.output_tile_res, self.stride, self.overlap
+        window = OverlapAdd(res, field.shape[1], self.channels_a)
+
+        head = None
+        tail = None
+        for i in range(i0, i1):
+            window.add_grid(self.tile_row(i)[np.newaxis], (0, 0), stride, self.weight_mask_a)
+            row = i * stride
+
+            # Rows shared with the band before
+            start = 0
+            if i == i0 and i0 > 0:
+                head = (window.values[:overlap].copy(), window.weights[:overlap].copy())
+                start = overlap
+
+            # Rows shared with the band after, the last tile row of the field finishes all its rows
+            end = stride
+            if i == i1 - 1:
+                if i1 == self.tiles_per_row:
+                    end = res
+                else:
+                    tail = (window.values[stride:].copy(), window.weights[stride:].copy())
+
+            field[row + start:row + end] = window.values[start:end] / (window.weights[start:end] + 1e-8)
+
+            # Slide the window down by one tile row
+            window.values[:res - stride] = window.values[stride:]
+            window.values[res - stride:] = 0.0
+            window.weights[:res - stride] = window.weights[stride:]
+            window.weights[res - stride:] = 0.0
+
+        return head, tail
+
+    def merge_halo(self, field, i, tail, head):
+        # Finish the rows shared by the band ending before tile row i and the band starting at it
+        merge_halo(field, i * self.stride, tail, head)
+
+    def block_size(self, halo):
+        # Side in latent pixels of the largest halo-padded block gen_b can render within the memory budget
+        side = int(np.sqrt(self.memory_bytes / self.pixel_bytes)) - 2 * halo
+        return max(1, min(side, self.field_res))
+
+    def render_band(self, field, output, y, y_end, halo=4):
+        # Render latent rows y:y_end in blocks that fit the memory budget
+        block = self.block_size(halo)
+        for yb in range(y, y_end, block):
+            for x in range(0, field.shape[1], block):
+                self.tg.render_region(field, output, yb, min(yb + block, y_end),
+                                      x, min(x + block, field.shape[1]), halo)
+
+    def bake_latent_field(self):
+        print('Baking latent field...')
+        field = self.open_field('latent_field', [self.field_res, self.field_res, self.channels_a])
+        self.latent_band(field, 0, self.tiles_per_row)
+        field.flush()
+        return field
+
+    def bake_output(self, halo=4):
+        # Render the baked latent field into the output field, gen_b outputs lie in [-1, 1]
+        print('Baking output...')
+        field = self.open_field('latent_field')
+        output_res = int(self.field_res * self.tg.b_scaling)
+        output = self.open_field('output', [output_res, output_res, self.tg.pgg.channels])
+        self.render_band(field, output, 0, self.field_res, halo)
+
+        output.flush()
+        return output
+
+    def bake(self, halo=4):
+        self.bake_latent_field()
+        return self.bake_output(halo)
+
+
+if __name__ == '__main__':
+
+    from tile_experiment import TerrainGenerator
+
+    tg = TerrainGenerator('pgf6', segment_idx=2)
+
+    # A 16k x 16k output with 8x upsampling after the split
+    baker = FieldBaker(tg, root_dir + 'results/field_bake/', field_res=2048, overlap=4,
+                       lm_version='msm10', lm_attribute='mean_5', memory_bytes=2 ** 30)
+    out = baker.bake()
+    print(out.shape, np.amin(out[::64, ::64]), np.amax(out[::64, ::64]))
@@ -0,0 +1,46 @@
+import numpy as np
+import tensorflow as tf
+
+
+class InferenceModel(object):
+    """
+    Serving wrapper around a Keras model. The forward pass is traced once as a
+    concrete function with a fixed input signature (any batch size), which skips
+    the per-call setup of Model.predict. Inputs and outputs are numpy arrays.
+    Arguments:
+      model: a single-input, single-output Keras model.
+      jit_compile: compile the forward pass with XLA.
+      warmup_batch_sizes: batch sizes to run once on construction so the first
+        real call does not pay for tracing (or XLA compilation per shape).
+    """
+
+    def __init__(self, model, jit_compile=False, warmup_batch_sizes=(1,)):
+
+        self.model = model
+        self.jit_compile = jit_compile
+        self.input_shape = tuple(model.inputs[0].shape[1:])
+        self.output_shape = tuple(model.outputs[0].shape[1:])
+
+        signature = [tf.TensorSpec(shape=(None,) + self.input_shape, dtype=tf.float32)]
+        self.forward = tf.function(self._forward,
+                                   input_signature=signature,
+                                   jit_compile=jit_compile).get_concrete_function()
+
+        self.warmup(warmup_batch_sizes)
+
+    def _forward(self, inputs):
+        return self.model(inputs, training=False)
+
+    def warmup(self, batch_sizes):
+        for batch_size in batch_sizes:
+            self(np.zeros(shape=(batch_size,) + self.input_shape, dtype=np.float32))
+
+    def __call__(self, inputs, batch_size=None):
+        inputs = np.asarray(inputs, dtype=np.float32)
+        if batch_size is None or inputs.shape[0] <= batch_size:
+            return self.forward(tf.constant(inputs)).numpy()
+
+        # Split large inputs into chunks to bound memory use
+        outputs = [self.forward(tf.constant(inputs[i:i + batch_size])).numpy()
+                   for i in range(0, inputs.shape[0], batch_size)]
+        return np.concatenate(outputs, axis=0)
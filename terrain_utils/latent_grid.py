@@ -0,0 +1,106 @@
+"""
+Latent grid sources for latent fields (see TerrainGenerator.random_latent_field and FieldBaker).
+A source is called as source(start, stop, n_cols) and returns the latents of tile rows
+start:stop and tile columns 0:n_cols as a [stop - start, n_cols, latent_size] array. Rows are
+produced lazily and the same rows always give the same latents, so grids of any size can be
+read in chunks, by several processes at once. Sources are picklable.
+"""
+
+import numpy as np
+
+from latent_source import *
+
+
+class ArrayLatentGrid(object):
+    """Latent grid held in a [rows, cols, latent_size] array (or memmap)"""
+
+    def __init__(self, latents):
+        self.latents = latents
+
+    def __call__(self, start, stop, n_cols):
+        rows, cols = self.latents.shape[:2]
+        assert stop <= rows and n_cols <= cols, \
+            'latent grid of {} x {} tiles is too small for {} x {}'.format(rows, cols, stop, n_cols)
+        return np.asarray(self.latents[start:stop, :n_cols], dtype=np.float32)
+
+
+class FileLatentGrid(ArrayLatentGrid):
+    """Latent grid in a .npy file, memory-mapped so only the rows read are loaded"""
+
+    def __init__(self, path):
+        self.path = path
+        super(FileLatentGrid, self).__init__(np.load(path, mmap_mode='r'))
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+
+class RandomLatentGrid(object):
+    """Independent standard normal latents, every row drawn from its own seeded generator"""
+
+    def __init__(self, latent_size, seed=None):
+        self.latent_size = latent_size
+        self.seed = seed if seed is not None else int(np.random.randint(2 ** 31))
+
+    def __call__(self, start, stop, n_cols):
+        return np.stack([np.random.default_rng([self.seed, row]).standard_normal((n_cols, self.latent_size))
+                         for row in range(start, stop)]).astype(np.float32)
+
+
+class CoordinateLatentGrid(object):
+    """Coordinate-hashed latents (see coordinate_latents) of a block of tiles on one face"""
+
+    def __init__(self, latent_size, seed=0, face=0, x=0, y=0):
+        self.latent_size = latent_size
+        self.seed = seed
+        self.face = face
+        self.x = x
+        self.y = y
+
+    def __call__(self, start, stop, n_cols):
+        xs, ys = np.meshgrid(np.arange(self.x, self.x + n_cols), np.arange(self.y + start, self.y + stop))
+        return coordinate_latents(self.face, xs, ys, self.latent_size, self.seed)
+
+
+class SmoothLatentGrid(object):
+    """
+    Spatially smooth latents: coordinate-hashed control latents every cell tiles, blended
+    bilinearly with a smoothstep and rescaled so every latent is still standard normal.
+    detail mixes in independent latents per tile, from 0 (smooth) to 1 (white noise).
+    """
+
+    def __init__(self, latent_size, seed=0, cell=4, detail=0.0):
+        self.latent_size = latent_size
+        self.seed = seed
+        self.cell = cell
+        self.detail = detail
+
+    def __call__(self, start, stop, n_cols):
+
+        # Position of every tile within its lattice cell
+        ys = np.arange(start, stop) / self.cell
+        xs = np.arange(n_cols) / self.cell
+        y0, x0 = np.floor(ys).astype(np.int64), np.floor(xs).astype(np.int64)
+        ty, tx = ys - y0, xs - x0
+        ty, tx = ty * ty * (3 - 2 * ty), tx * tx * (3 - 2 * tx)
+
+        # Control latents at the four corners of every cell, seeded apart from the per-tile detail
+        ly, lx = np.meshgrid(np.arange(y0[0], y0[-1] + 2), np.arange(x0[0], x0[-1] + 2), indexing='ij')
+        lattice = coordinate_latents(-1, lx, ly, self.latent_size, self.seed)
+        iy, ix = (y0 - y0[0])[:, np.newaxis], (x0 - x0[0])[np.newaxis, :]
+
+        wy, wx = ty[:, np.newaxis, np.newaxis], tx[np.newaxis, :, np.newaxis]
+        weights = [(1 - wy) * (1 - wx), (1 - wy) * wx, wy * (1 - wx), wy * wx]
+        corners = [lattice[iy, ix], lattice[iy, ix + 1], lattice[iy + 1, ix], lattice[iy + 1, ix + 1]]
+        smooth = sum(w * c for w, c in zip(weights, corners))
+        smooth /= np.sqrt(sum(w ** 2 for w in weights))
+
+        if self.detail > 0:
+            xs, ys = np.meshgrid(np.arange(n_cols), np.arange(start, stop))
+            white = coordinate_latents(0, xs, ys, self.latent_size, self.seed)
+            smooth = np.sqrt(1 - self.detail ** 2) * smooth + self.detail * white
+
+        return smooth.astype(np.float32)
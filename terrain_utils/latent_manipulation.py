@@ -4,6 +4,7 @@ import numpy as np
 
 from util import *
 from model import *
+from inference import *
 
 
 class LatentManipulator(Session):
@@ -77,7 +78,7 @@ class LatentManipulator(Session):
 
             print('Generating images...')
 
-            raw_images = tf.constant(gen.predict(latents, batch_size=16, verbose=1), dtype=tf.float32)
+            raw_images = tf.constant(InferenceModel(gen)(latents, batch_size=16), dtype=tf.float32)
             norm = (raw_images[:, :, :, 0] + 1.0) / 2.0
             images = (raw_images[:, :, :, 1] + 1.0) / 2.0
 
@@ -102,16 +103,19 @@ class LatentManipulator(Session):
         np.savez_compressed(self.path, **self.boundaries)
         print('--Boundaries saved')
 
-    def center_latent(self, latent, semantic):
+    def unit_boundary(self, semantic):
         n = self.boundaries[semantic][0]
-        z = latent
-        z -= n
-        n /= np.linalg.norm(n)
+        return n / np.linalg.norm(n)
+
+    def center_latent(self, latent, semantic):
+        # Works on a single latent or a batch of latents along the first axis
+        n = self.unit_boundary(semantic)
+        z = latent - n
         z = z - n * np.dot(n[0], z)
         return z
 
     def move_latent(self, latent, semantic, delta):
-        return latent + delta * self.boundaries[semantic][0]
+        return latent + delta * self.unit_boundary(semantic)
 
     def move_latent_conditional(self):
         pass
@@ -0,0 +1,64 @@
+import numpy as np
+
+GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+
+
+def splitmix64(z):
+    # SplitMix64 finalizer of a uint64 array, wrapping around on overflow
+    with np.errstate(over='ignore'):
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def coordinate_hash(seed, *coords):
+    # Hash integer coordinate arrays (broadcast together) into one uint64 state per coordinate
+    with np.errstate(over='ignore'):
+        h = splitmix64(np.asarray(seed, dtype=np.int64).astype(np.uint64) + GOLDEN_GAMMA)
+        for c in coords:
+            h = splitmix64((h ^ np.asarray(c, dtype=np.int64).astype(np.uint64)) + GOLDEN_GAMMA)
+    return h
+
+
+def coordinate_latents(faces, xs, ys, latent_size, seed=0):
+    """
+    Standard normal latents derived from tile coordinates alone. Each (face, x, y, seed) is
+    hashed into the state of a counter-based SplitMix64 stream, whose uniforms are turned
+    pairwise into latent_size normals with the Box-Muller transform. Coordinates are integer
+    arrays of any matching shape S, the result has shape S + [latent_size]. Nothing is
+    stored, the same coordinates always give the same latent on any machine.
+    """
+
+    h = coordinate_hash(seed, faces, xs, ys)
+    n_pairs = (latent_size + 1) // 2
+
+    # Counter k of the stream of every coordinate, two uniforms per normal pair
+    with np.errstate(over='ignore'):
+        counters = np.arange(1, 2 * n_pairs + 1, dtype=np.uint64) * GOLDEN_GAMMA
+        bits = splitmix64(h[..., np.newaxis] + counters)
+    uniforms = (bits >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+    # Box-Muller, u1 in (0, 1] so the log is finite
+    u1 = 1.0 - uniforms[..., 0::2]
+    u2 = uniforms[..., 1::2]
+    radius = np.sqrt(-2.0 * np.log(u1))
+    angle = 2.0 * np.pi * u2
+    normals = np.stack([radius * np.cos(angle), radius * np.sin(angle)], axis=-1)
+
+    return normals.reshape(normals.shape[:-2] + (2 * n_pairs,))[..., :latent_size].astype(np.float32)
+
+
+class LatentSource(object):
+    """Server-side latents of a world, see coordinate_latents"""
+
+    def __init__(self, latent_size, seed=0):
+        self.latent_size = latent_size
+        self.seed = seed
+
+    def latents(self, faces, xs, ys):
+        return coordinate_latents(faces, xs, ys, self.latent_size, self.seed)
+
+    def region(self, face, x, y, width, height):
+        # Latents of a block of tiles on one face as a [height, width, latent_size] array, row index is y
+        ys, xs = np.mgrid[y:y + height, x:x + width]
+        return self.latents(np.full_like(xs, face), xs, ys)
@@ -1,5 +1,6 @@
 from tensorflow.keras.layers import Layer, Add, Wrapper
 
+import tensorflow as tf
 import tensorflow.keras.backend as K
 
 
@@ -20,6 +21,19 @@ class PixelNormalization(Layer):
         return input_shape
 
 
+class FusedPixelNormalization(Layer):
+    """Inference-only PixelNormalization computed as a single rsqrt-multiply"""
+
+    def __init__(self, **kwargs):
+        super(FusedPixelNormalization, self).__init__(**kwargs)
+
+    def call(self, inputs, **kwargs):
+        return inputs * tf.math.rsqrt(K.mean(K.square(inputs), axis=-1, keepdims=True) + 1.0e-8)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+
 class MinibatchStdev(Layer):
 
     def __init__(self, **kwargs):
@@ -41,21 +41,32 @@ class PGGAN:
             assert len(n_fmap) == n_blocks, 'n_fmap must be int or list of ints size n_blocks'
             self.n_fmap = n_fmap
 
-    def gen_block(self, x, block):
-
-        x = EqualizeLearningRate(Conv2D(self.n_fmap[block],
-                                        kernel_size=self.kernel_size,
-                                        padding=self.padding,
-                                        kernel_initializer=self.kernel_initializer),
-                                 name='block{}_conv1'.format(block))(x)
-        x = PixelNormalization()(x)
+    def equalized(self, layer_class, name, fused=False, **kwargs):
+        # Inference-only graphs use the plain layer, with the He constant folded into its weights
+        if fused:
+            return layer_class(name=name, **kwargs)
+        return EqualizeLearningRate(layer_class(**kwargs), name=name)
+
+    def pixel_norm(self, fused=False):
+        if fused:
+            return FusedPixelNormalization()
+        return PixelNormalization()
+
+    def gen_block(self, x, block, fused=False):
+
+        x = self.equalized(Conv2D, 'block{}_conv1'.format(block), fused,
+                           filters=self.n_fmap[block],
+                           kernel_size=self.kernel_size,
+                           padding=self.padding,
+                           kernel_initializer=self.kernel_initializer)(x)
+        x = self.pixel_norm(fused)(x)
         x = LeakyReLU()(x)
-        x = EqualizeLearningRate(Conv2D(self.n_fmap[block],
-                                        kernel_size=self.kernel_size,
-                                        padding=self.padding,
-                                        kernel_initializer=self.kernel_initializer),
-                                 name='block{}_conv2'.format(block))(x)
-        x = PixelNormalization()(x)
+        x = self.equalized(Conv2D, 'block{}_conv2'.format(block), fused,
+                           filters=self.n_fmap[block],
+                           kernel_size=self.kernel_size,
+                           padding=self.padding,
+                           kernel_initializer=self.kernel_initializer)(x)
+        x = self.pixel_norm(fused)(x)
         x = LeakyReLU()(x)
 
         return x
@@ -225,47 +236,56 @@ class PGGAN:
 
         return model
 
-    def build_gen_stable(self, split_idx=-1):
+    def build_gen_stable(self, split_idx=-1, fused=False, end_block=None, any_size=False):
+
+        # With end_block the generator stops after that block and ends in its own to_channels head,
+        # with any_size gen_b is fully convolutional and takes latent fields of any height and width
+        if end_block is None:
+            end_block = self.n_blocks - 1
+        assert split_idx <= end_block, 'generator must not end before the split'
 
         # Input block
         in_latent = Input(shape=(self.latent_size,),
                           name='input_latent')
 
-        x = EqualizeLearningRate(Dense(units=self.n_fmap[0] * self.init_res * self.init_res,
-                                       kernel_initializer=self.kernel_initializer),
-                                 name='base_dense')(in_latent)
-        x = PixelNormalization()(x)
+        x = self.equalized(Dense, 'base_dense', fused,
+                           units=self.n_fmap[0] * self.init_res * self.init_res,
+                           kernel_initializer=self.kernel_initializer)(in_latent)
+        x = self.pixel_norm(fused)(x)
         x = LeakyReLU()(x)
         x = Reshape((self.init_res, self.init_res, self.n_fmap[0]))(x)
-        x = EqualizeLearningRate(Conv2D(self.n_fmap[0],
-                                        kernel_size=self.kernel_size,
-                                        padding=self.padding,
-                                        kernel_initializer=self.kernel_initializer),
-                                 name='base_conv')(x)
-        x = PixelNormalization()(x)
+        x = self.equalized(Conv2D, 'base_conv', fused,
+                           filters=self.n_fmap[0],
+                           kernel_size=self.kernel_size,
+                           padding=self.padding,
+                           kernel_initializer=self.kernel_initializer)(x)
+        x = self.pixel_norm(fused)(x)
         x = LeakyReLU()(x)
 
         out_tile = None
         in_tile = None
 
         # Remaining blocks
-        for i in range(1, self.n_blocks):
+        for i in range(1, end_block + 1):
 
             if i == split_idx:
                 out_tile = x
                 self.interm_res = out_tile.shape[1]
-                in_tile = Input(shape=out_tile.shape[1:], name='tile_input')
+                if any_size:
+                    in_tile = Input(shape=(None, None, out_tile.shape[-1]), name='tile_input')
+                else:
+                    in_tile = Input(shape=out_tile.shape[1:], name='tile_input')
                 x = in_tile
 
             up = UpSampling2D()(x)
-            x = self.gen_block(up, i)
+            x = self.gen_block(up, i, fused)
 
         # Final block output
-        x = EqualizeLearningRate(Conv2D(self.channels,
-                                        kernel_size=1,
-                                        padding=self.padding,
-                                        kernel_initializer=self.kernel_initializer),
-                                 name='to_channels_{}'.format(self.n_blocks - 1))(x)
+        x = self.equalized(Conv2D, 'to_channels_{}'.format(end_block), fused,
+                           filters=self.channels,
+                           kernel_size=1,
+                           padding=self.padding,
+                           kernel_initializer=self.kernel_initializer)(x)
 
         if split_idx > 0:
             gen_a = Model(inputs=in_latent, outputs=out_tile, name='gen_a')
@@ -274,3 +294,15 @@ class PGGAN:
 
         gen = Model(inputs=in_latent, outputs=x, name='gen')
         return gen
+
+    def build_head(self, block):
+
+        # The to_channels head of a block on its own, applied to block outputs of any size
+        in_tile = Input(shape=(None, None, self.n_fmap[block]), name='tile_input')
+        x = EqualizeLearningRate(Conv2D(self.channels,
+                                        kernel_size=1,
+                                        padding=self.padding,
+                                        kernel_initializer=self.kernel_initializer),
+                                 name='to_channels_{}'.format(block))(in_tile)
+
+        return Model(inputs=in_tile, outputs=x, name='head_{}'.format(block))
@@ -0,0 +1,210 @@
+import os
+import time
+import multiprocessing as mp
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from field_baker import *
+
+# FieldBaker of this worker process
+_baker = None
+
+
+def _init_worker(counter, cores, n_workers, inter_op_threads, session_id, segment_idx, generator_kwargs,
+                 baker_kwargs):
+
+    # Pin this worker to its slice of cores before TensorFlow creates its thread pools
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    worker_cores = cores[index * len(cores) // n_workers:(index + 1) * len(cores) // n_workers]
+    if worker_cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, worker_cores)
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(max(1, len(worker_cores)))
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+    from tile_experiment import TerrainGenerator
+
+    global _baker
+    tg = TerrainGenerator(session_id, segment_idx, **generator_kwargs)
+    _baker = FieldBaker(tg, **baker_kwargs)
+
+
+def _geometry():
+    return {'field_res': _baker.field_res,
+            'tiles_per_row': _baker.tiles_per_row,
+            'stride': _baker.stride,
+            'overlap': _baker.overlap,
+            'channels_a': _baker.channels_a,
+            'channels': _baker.tg.pgg.channels,
+            'b_scaling': _baker.tg.b_scaling}
+
+
+def _latent_band(i0, i1):
+    start = time.perf_counter()
+    field = _baker.open_field('latent_field')
+    head, tail = _baker.latent_band(field, i0, i1)
+    field.flush()
+    return head, tail, time.perf_counter() - start
+
+
+def _render_band(y, y_end, halo):
+    start = time.perf_counter()
+    field = _baker.open_field('latent_field')
+    output = _baker.open_field('output')
+    _baker.render_band(field, output, y, y_end, halo)
+    output.flush()
+    return time.perf_counter() - start
+
+
+def split(n, parts):
+    # Boundaries of up to parts contiguous, nearly equal ranges covering range(n)
+    parts = max(1, min(parts, n))
+    return [n * k // parts for k in range(parts + 1)]
+
+
+class ParallelFieldBaker(object):
+    """
+    FieldBaker spread over a pool of worker processes, each pinned to its own slice of cores
+    with its own gen_a and gen_b. Tile rows of the latent field are split into bands, every
+    worker writes the rows only its band covers straight into the shared latent memmap and
+    sends back the overlap rows it shares with the neighbouring bands, which the server sums
+    and normalizes. gen_b then renders row bands of the finished latent field, reading the
+    halo of each band from the memmap. The result is the same as a serial FieldBaker.
+    Arguments:
+      n_workers: worker processes, by default one per 4 cores.
+      bands_per_worker: bands per worker and stage, more bands balance the load better.
+      memory_bytes: memory budget shared by all workers.
+      baker_kwargs: further FieldBaker arguments.
+    """
+
+    def __init__(self, session_id, segment_idx, path, field_res, n_workers=None, bands_per_worker=2,
+                 memory_bytes=8 * 2 ** 30, generator_kwargs=None, inter_op_threads=1, **baker_kwargs):
+
+        if hasattr(os, 'sched_getaffinity'):
+            cores = sorted(os.sched_getaffinity(0))
+        else:
+            cores = list(range(os.cpu_count()))
+        if n_workers is None:
+            n_workers = max(1, len(cores) // 4)
+        n_workers = min(n_workers, len(cores))
+
+        self.path = path
+        self.n_workers = n_workers
+        self.bands = n_workers * bands_per_worker
+        self.timings = {}
+
+        baker_kwargs = dict(baker_kwargs, path=path, field_res=field_res, memory_bytes=memory_bytes // n_workers)
+
+        # TensorFlow does not survive fork, so workers are always spawned
+        ctx = mp.get_context('spawn')
+        self.pool = ProcessPoolExecutor(n_workers, mp_context=ctx, initializer=_init_worker,
+                                        initargs=(ctx.Value('i', 0), cores, n_workers, inter_op_threads, session_id,
+                                                  segment_idx, generator_kwargs or {}, baker_kwargs))
+        self.geometry = self.pool.submit(_geometry).result()
+
+    def open_field(self, name, shape=None):
+        file_name = os.path.join(self.path, name + '.npy')
+        if shape is None:
+            return np.lib.format.open_memmap(file_name, mode='r+')
+        return np.lib.format.open_memmap(file_name, mode='w+', dtype=np.float32, shape=tuple(shape))
+
+    def bake_latent_field(self):
+        print('Baking latent field with {} workers...'.format(self.n_workers))
+        g = self.geometry
+        start = time.perf_counter()
+
+        field = self.open_field('latent_field', [g['field_res'], g['field_res'], g['channels_a']])
+        field.flush()
+        cuts = split(g['tiles_per_row'], self.bands)
+        jobs = [self.pool.submit(_latent_band, i0, i1) for i0, i1 in zip(cuts[:-1], cuts[1:])]
+        results = [job.result() for job in jobs]
+
+        # Halo exchange: rows shared by neighbouring bands are finished from both halves
+        for k in range(1, len(results)):
+            merge_halo(field, cuts[k] * g['stride'], results[k - 1][1], results[k][0])
+        field.flush()
+
+        self.timings['latent_field'] = (time.perf_counter() - start, [result[2] for result in results])
+        return field
+
+    def bake_output(self, halo=4):
+        print('Baking output with {} workers...'.format(self.n_workers))
+        g = self.geometry
+        start = time.perf_counter()
+
+        output_res = int(g['field_res'] * g['b_scaling'])
+        output = self.open_field('output', [output_res, output_res, g['channels']])
+        output.flush()
+        cuts = split(g['field_res'], self.bands)
+        jobs = [self.pool.submit(_render_band, y, y_end, halo) for y, y_end in zip(cuts[:-1], cuts[1:])]
+        busy = [job.result() for job in jobs]
+
+        self.timings['output'] = (time.perf_counter() - start, busy)
+        return self.open_field('output')
+
+    def bake(self, halo=4):
+        self.bake_latent_field()
+        return self.bake_output(halo)
+
+    def stats(self, serial_seconds=None):
+        """
+        Wall and busy time of each stage. Efficiency is the busy share of n_workers times
+        the wall time, with the run time of a serial bake it is serial_seconds over that.
+        """
+        stats = {'workers': self.n_workers}
+        for stage, (wall, busy) in self.timings.items():
+            stats[stage] = {'wall': wall,
+                            'busy': sum(busy),
+                            'bands': len(busy),
+                            'efficiency': sum(busy) / (wall * self.n_workers) if wall > 0 else 0.0}
+        if serial_seconds is not None and self.timings:
+            wall = sum(wall for wall, _ in self.timings.values())
+            stats['speedup'] = serial_seconds / wall
+            stats['efficiency'] = serial_seconds / (wall * self.n_workers)
+        return stats
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def compare_with_serial(session_id, segment_idx, path, n_workers=None, overlap=4, lm_version='msm10',
+                        lm_attribute='mean_5', atol=1e-4):
+    """
+    Bake the sample latents of a session in parallel and compare the latent field and output
+    with the serial in-memory pipeline (TerrainGenerator.random_latent_field, then
+    render_latent_field). Returns the largest absolute differences and the scaling stats.
+    """
+
+    from tile_experiment import TerrainGenerator
+
+    tg = TerrainGenerator(session_id, segment_idx)
+    latents = np.reshape(tg.config['sample_latents'], [8, 8, tg.pgg.latent_size])
+    field_res = 8 * (tg.tile_res - overlap) + overlap
+
+    start = time.perf_counter()
+    tg.random_latent_field(field_res, overlap=overlap, lm_version=lm_version, lm_attribute=lm_attribute)
+    expected = tg.render_latent_field()
+    serial_seconds = time.perf_counter() - start
+
+    baker = ParallelFieldBaker(session_id, segment_idx, path, field_res, n_workers,
+                               latent_rows=ArrayLatentGrid(latents), overlap=overlap,
+                               lm_version=lm_version, lm_attribute=lm_attribute)
+    output = baker.bake()
+    latent_error = float(np.amax(np.abs(np.asarray(baker.open_field('latent_field')) - tg.latent_field)))
+    output_error = float(np.amax(np.abs(np.asarray(output) - expected)))
+    stats = baker.stats(serial_seconds)
+    baker.close()
+
+    assert latent_error <= atol and output_error <= atol, \
+        'parallel bake deviates from the serial pipeline: {}, {} > {}'.format(latent_error, output_error, atol)
+    return latent_error, output_error, stats
+
+
+if __name__ == '__main__':
+
+    print(compare_with_serial('pgf6', 2, root_dir + 'results/parallel_bake_check/'))
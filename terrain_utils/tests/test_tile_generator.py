@@ -0,0 +1,160 @@
+import os
+import sys
+import types
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('tensorflow')
+
+from tile_generator import *
+
+RES_A = 8
+OVERLAP = 2
+CHANNELS_A = 4
+LATENT_SIZE = 16
+
+
+class CountingGenerator(object):
+    # Stands in for a generator: a fixed random projection, counting the tiles it renders
+
+    def __init__(self, latent_res, out_res, in_channels, out_channels, seed):
+        self.outputs = [types.SimpleNamespace(shape=(None, out_res, out_res, out_channels))]
+        self.weights = np.random.default_rng(seed).standard_normal((in_channels, out_channels)).astype(np.float32)
+        self.latent_res = latent_res
+        self.out_res = out_res
+        self.calls = []
+
+    def __call__(self, batch):
+        self.calls.append(len(batch))
+        if batch.ndim == 2:
+            batch = np.tile(batch[:, np.newaxis, np.newaxis, :CHANNELS_A], (1, self.latent_res, self.latent_res, 1))
+        scale = self.out_res // batch.shape[1]
+        batch = np.repeat(np.repeat(batch, scale, axis=1), scale, axis=2)
+        return np.tanh(batch @ self.weights)
+
+
+class IdentityManipulator(object):
+
+    def center_latent(self, latents, attribute):
+        return latents
+
+    def move_latent(self, latents, attribute, delta):
+        return latents
+
+
+def tile_generator(shared_windows=False):
+    # A TileGenerator around stand-in generators, set up the way __init__ sets up a real one
+    tg = TileGenerator.__new__(TileGenerator)
+    tg.overlap = OVERLAP
+    tg.res_a = RES_A
+    tg.gen_a = CountingGenerator(RES_A, RES_A, CHANNELS_A, CHANNELS_A, 0)
+    tg.gen_b = CountingGenerator(RES_A, 2 * RES_A, CHANNELS_A, 2, 1)
+    tg.infer_a = tg.gen_a
+    tg.infer_b = tg.gen_b
+    tg.latent_tile_cache = TileCache()
+    tg.window_cache = TileCache()
+    tg.weight_mask_a = weight_mask(RES_A, 1)
+    tg.chunk_size_a = RES_A * 3 - OVERLAP * 2
+    tg.offsets_a = [((RES_A - OVERLAP) * (2 - i), (RES_A - OVERLAP) * j) for i in range(3) for j in range(3)]
+    tg.levels = [RenderLevel(0, tg.gen_b, tg.infer_b, RES_A, OVERLAP, tg.offsets_a)]
+    tg.lm_version, tg.lm_attribute, tg.lm_delta = 'test', 'test', 0.0
+    tg.lm = IdentityManipulator()
+    tg.prefetch_enabled = False
+    tg.shared_windows = shared_windows
+    return tg
+
+
+def request(x, y):
+    # 3x3 neighbourhood centered on tile (x, y) of a flat grid, latents derived from the tile coordinates
+    coords = [(x + dx, y + dy) for dy in (1, 0, -1) for dx in (-1, 0, 1)]
+    tile_ids = [(cy + 100) * 1000 + cx + 100 for cx, cy in coords]
+    latents = np.stack([np.random.default_rng([cx + 100, cy + 100]).standard_normal(LATENT_SIZE)
+                        for cx, cy in coords]).astype(np.float32)
+    return latents, tile_ids, [0] * 9, '{} {}'.format(x, y)
+
+
+def baseline_tile(tg, latents, tile_ids, rotations):
+    # The tile as generate_tile rendered it before windows were cached: blend the 3x3 latent tiles,
+    # run gen_b on all nine windows of the blended chunk and blend the outputs
+    res_b = tg.gen_b.outputs[0].shape[1]
+    scale_b = res_b / tg.res_a
+    chunk_size_a = tg.res_a * 3 - tg.overlap * 2
+    chunk_a = np.zeros(shape=(chunk_size_a, chunk_size_a, CHANNELS_A))
+    weight_map_a = np.zeros(shape=(chunk_size_a, chunk_size_a, 1))
+    for k, (y, x) in enumerate(tg.offsets_a):
+        if str(tile_ids[k]) != '-1':
+            tile = np.rot90(tg.gen_a(np.asarray([latents[k]]))[0], rotations[k], axes=(0, 1))
+            chunk_a[y:y + tg.res_a, x:x + tg.res_a] += tile * tg.weight_mask_a
+            weight_map_a[y:y + tg.res_a, x:x + tg.res_a] += tg.weight_mask_a
+    chunk_a /= weight_map_a + 1e-8
+
+    chunk_size_b = int(chunk_size_a * scale_b)
+    chunk_b = np.zeros(shape=(chunk_size_b, chunk_size_b, 2))
+    weight_map_b = np.zeros(shape=(chunk_size_b, chunk_size_b, 1))
+    weight_mask_b = weight_mask(res_b, 4)
+    for k, (ya, xa) in enumerate(tg.offsets_a):
+        yb, xb = int(ya * scale_b), int(xa * scale_b)
+        window = np.rot90(chunk_a[ya:ya + tg.res_a, xa:xa + tg.res_a], -rotations[k], (0, 1))
+        tile_b = np.rot90(tg.gen_b(np.asarray([window], dtype=np.float32))[0], rotations[k], (0, 1))
+        chunk_b[yb:yb + res_b, xb:xb + res_b] += (tile_b + 1.0) / 2.0 * weight_mask_b
+        weight_map_b[yb:yb + res_b, xb:xb + res_b] += weight_mask_b
+    chunk_b /= weight_map_b + 1e-8
+
+    tile_start = int((tg.res_a - tg.overlap / 2) * scale_b)
+    out_res = int((tg.res_a - tg.overlap) * scale_b)
+    return chunk_b[tile_start:tile_start + out_res, tile_start:tile_start + out_res]
+
+
+def rotated(latents, tile_ids, rotations, name):
+    return latents, tile_ids, [(k * 3) % 4 for k in range(9)], name
+
+
+def edge(latents, tile_ids, rotations, name):
+    return latents, tile_ids[:6] + [-1] * 3, rotations, name
+
+
+def test_matches_baseline_tiles():
+    tg = tile_generator()
+    requests = [request(0, 0), rotated(*request(1, 0)), edge(*request(2, 0))]
+    tiles = tg.generate_tiles(requests, save_img=False)
+    for tile, req in zip(tiles, requests):
+        assert np.allclose(tile, baseline_tile(tile_generator(), *req[:3]), atol=1e-5)
+
+    # Served again from the window cache
+    again = tg.generate_tiles(requests, save_img=False)
+    assert tg.gen_b.calls == [27]
+    for tile, tile_again in zip(tiles, again):
+        assert np.array_equal(tile, tile_again)
+
+
+def test_cached_windows_give_the_same_tile():
+    tg = tile_generator()
+    _, tile = tg.generate_tiles([request(0, 0), request(1, 0)], save_img=False)
+    fresh = tile_generator().generate_tiles([request(1, 0)], save_img=False)[0]
+    assert np.allclose(tile, fresh, atol=1e-6)
+
+
+def test_shared_windows_across_neighbouring_requests():
+    tg = tile_generator(shared_windows=True)
+    tg.generate_tiles([request(0, 0)], save_img=False)
+    assert tg.gen_b.calls == [9]
+
+    # The tile to the right shares six tiles, all but the old center are outer windows in both requests
+    tg.generate_tiles([request(1, 0)], save_img=False)
+    assert tg.window_cache.hits == 4
+    assert tg.gen_b.calls == [9, 5]
+
+
+def test_shared_windows_seams():
+    # Shared windows change the tiles, compare the jump across the seam of two neighbouring tiles
+    def seam(tg):
+        left, right = tg.generate_tiles([request(0, 0), request(1, 0)], save_img=False)
+        return np.abs(left[:, -1] - right[:, 0]).mean(), left
+
+    blended, baseline = seam(tile_generator())
+    shared, tile = seam(tile_generator(shared_windows=True))
+    assert not np.allclose(tile, baseline, atol=1e-5)
+    assert shared < 2.0 * blended + 1e-3
@@ -0,0 +1,90 @@
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+def array_digest(*arrays, params=()):
+    # Hash the raw contents of some arrays together with any extra parameters
+    h = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array, dtype=np.float32)
+        h.update(str(array.shape).encode())
+        h.update(array.tobytes())
+    h.update(repr(tuple(params)).encode())
+    return h.hexdigest()
+
+
+class TileCache(object):
+    """
+    Thread-safe LRU store for generated tiles with a fixed memory budget.
+    Entries are numpy arrays, stored as compact copies and charged by their nbytes,
+    so a cached slice never keeps the batch it was cut from alive. Arrays handed
+    out by get() are shared with the cache and must not be modified.
+    """
+
+    def __init__(self, max_bytes=256 * 2 ** 20):
+
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        value = np.array(value, order='C', copy=True)
+        size = value.nbytes
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.n_bytes -= self.entries.pop(key).nbytes
+            self.entries[key] = value
+            self.n_bytes += size
+
+            # Evict least recently used entries until we are back under budget
+            while self.n_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.n_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries),
+                    'bytes': self.n_bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups > 0 else 0.0}
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
@@ -7,12 +7,15 @@ import util
 from model import *
 from util import *
 from latent_manipulation import *
+from inference import *
+from blend import *
+from latent_grid import *
 import noise as gn
 
 
 class TerrainGenerator(Session):
 
-    def __init__(self, session, segment_idx, steps=None):
+    def __init__(self, session, segment_idx, steps=None, jit_compile=False):
 
         super(TerrainGenerator, self).__init__(session)
 
@@ -35,74 +38,72 @@ class TerrainGenerator(Session):
         load_weights(self.gen_a, 'gen', version, self.session_id)
         load_weights(self.gen_b, 'gen', version, self.session_id)
 
+        self.infer_a = InferenceModel(self.gen_a, jit_compile)
+        self.infer_b = InferenceModel(self.gen_b, jit_compile)
+
+        # Fully convolutional copy of gen_b with the same weights for whole latent fields (see render_latent_field)
+        _, self.gen_b_field = self.pgg.build_gen_stable(segment_idx, any_size=True)
+        load_weights(self.gen_b_field, 'gen', version, self.session_id)
+        self.infer_b_field = InferenceModel(self.gen_b_field, jit_compile, warmup_batch_sizes=())
+
         self.latent_field = None
+        self.latent_manipulators = {}
         self.tiles_per_row = 0
         self.tile_res = self.pgg.interm_res
         self.b_scaling = self.pgg.final_res / self.tile_res
 
         print('Initialization complete')
 
-    def random_latent_field(self, field_res, cropping=0, overlap=0, lm_version=None, lm_attribute=None,  alpha=1.0):
+    def latent_manipulator(self, lm_version):
+        # Latent manipulators are loaded once per version
+        if lm_version not in self.latent_manipulators:
+            self.latent_manipulators[lm_version] = LatentManipulator(self.session_id, lm_version)
+        return self.latent_manipulators[lm_version]
+
+    def random_latent_field(self, field_res, cropping=0, overlap=0, lm_version=None, lm_attribute=None,  alpha=1.0,
+                            latent_grid=None, chunk_rows=8, batch_size=64):
+        """
+        Blend gen_a tiles of a grid of latents into a latent field of field_res x field_res.
+        latent_grid is a latent grid source (see latent_grid.py), by default the 8x8 sample
+        latents of the session. Latents are read chunk_rows tile rows at a time, every chunk
+        is centered and moved along lm_attribute as one block, run through gen_a in batches
+        of batch_size and added to the field as one grid of tiles.
+        """
         print('Generating random latent field...')
 
-        lm = LatentManipulator(self.session_id, lm_version)
+        lm = self.latent_manipulator(lm_version)
 
         output_tile_res = self.tile_res - (2 * cropping)
         stride = output_tile_res - overlap
 
         self.tiles_per_row = int((field_res - output_tile_res + stride) / stride)
 
-        self.latent_field = np.zeros(shape=[field_res, field_res, self.gen_a.output[-1].shape[-1]])
-        overlap_map = self.latent_field.copy()
-
-        weight_mask = np.zeros(shape=[output_tile_res, output_tile_res, self.gen_a.output[-1].shape[-1]])
-
-        center = np.asarray([output_tile_res / 2, output_tile_res / 2])
-        max_weight = np.linalg.norm(center)
-        for i in range(output_tile_res):
-            for j in range(output_tile_res):
-                pixel = np.asarray([i, j])
-                weight_mask[i, j, :] = (max_weight - np.linalg.norm(center - pixel)) ** 1 + 1
-
-        latents = np.asarray(self.config['sample_latents'])
-        print(latents.shape)
-        latents = np.reshape(latents, newshape=[8, 8, 128])
-        print(latents.shape)
-        #latents = np.random.normal(0, 1, size=[self.tiles_per_row, self.tiles_per_row, self.pgg.latent_size])
-        #latents_perlin = np.zeros(shape=[field_res, field_res, self.pgg.latent_size])
-        #for i in range(self.pgg.latent_size):
-        #    latents_perlin[:, :, i] = gn.generate_perlin_noise_2d(shape=[field_res, field_res], res=[4, 4])
-        #latents_perlin = latents_perlin[:self.tiles_per_row, :self.tiles_per_row]
-        #plt.imshow(latents_perlin[:, :, 0])
-        #plt.show()
-        #latents = alpha * latents + (1 - alpha) * latents_perlin
+        field = OverlapAdd(field_res, field_res, self.gen_a.output[-1].shape[-1])
+        weight_mask_a = weight_mask(output_tile_res, 1, symmetric=False)
 
-        for i in range(self.tiles_per_row):
-            delta = (i / (self.tiles_per_row - 1) * 2 - 1) * -4.0
-            for j in range(self.tiles_per_row):
+        if latent_grid is None:
+            latent_grid = ArrayLatentGrid(np.reshape(self.config['sample_latents'], [8, 8, self.pgg.latent_size]))
 
-                # Inputs
-                # latent = random_latents(self.pgg.latent_size, 1)
-                latent = latents[i, j]
-                latent = lm.center_latent(latent, lm_attribute)
-                latent = lm.move_latent(latent, lm_attribute, delta)
+        for i0 in range(0, self.tiles_per_row, chunk_rows):
+            i1 = min(i0 + chunk_rows, self.tiles_per_row)
 
-                # Generate intermediate latent tiles
-                tile = self.gen_a.predict(np.asarray([latent]))[0]
+            # Inputs, the delta runs across the rows of the field
+            latents = latent_grid(i0, i1, self.tiles_per_row).reshape([-1, self.pgg.latent_size])
+            delta = (np.arange(i0, i1) / (self.tiles_per_row - 1) * 2 - 1) * -4.0
+            delta = np.repeat(delta, self.tiles_per_row)[:, np.newaxis]
+            latents = lm.center_latent(latents, lm_attribute)
+            latents = lm.move_latent(latents, lm_attribute, delta)
 
-                if cropping > 0:
-                    tile = tile[cropping:-cropping, cropping:-cropping]
+            # Generate intermediate latent tiles
+            tiles = self.infer_a(latents, batch_size=batch_size)
 
-                tile *= weight_mask
+            if cropping > 0:
+                tiles = tiles[:, cropping:-cropping, cropping:-cropping]
 
-                ia = i * (output_tile_res - overlap)
-                ja = j * (output_tile_res - overlap)
+            tiles = tiles.reshape((i1 - i0, self.tiles_per_row) + tiles.shape[1:])
+            field.add_grid(tiles, (i0 * stride, 0), stride, weight_mask_a)
 
-                self.latent_field[ia:ia + output_tile_res, ja:ja + output_tile_res] += tile
-                overlap_map[ia:ia + output_tile_res, ja:ja + output_tile_res] += weight_mask
-
-        overlap_map += 1e-8
-        self.latent_field /= overlap_map
+        self.latent_field = field.result()
 
     def add_gradient_noise(self, factor=1.0, field_res=64):
 
@@ -122,20 +123,11 @@ class TerrainGenerator(Session):
         output_shape = [output_res, output_res, self.pgg.channels]
 
         # Blending variables
-        weight_mask = None
-        overlap_map = None
         if blend:
-            weight_mask = np.zeros(shape=[output_tile_res, output_tile_res, self.pgg.channels])
-            center = np.asarray([output_tile_res / 2, output_tile_res / 2])
-            max_weight = np.linalg.norm(center)
-            for i in range(output_tile_res):
-                for j in range(output_tile_res):
-                    pixel = np.asarray([i, j])
-                    weight_mask[i, j, :] = (max_weight - np.linalg.norm(center - pixel)) ** 4 + 1
-            overlap_map = np.zeros(shape=output_shape)
-
-        # Initialize output
-        output = np.zeros(shape=output_shape)
+            weight_mask_b = weight_mask(output_tile_res, 4, symmetric=False)
+            output = OverlapAdd(output_res, output_res, self.pgg.channels)
+        else:
+            output = np.zeros(shape=output_shape, dtype=np.float32)
 
         # Move gen_b across latent field
         steps = int((self.latent_field.shape[0] - self.tile_res + stride) / stride)
@@ -150,7 +142,7 @@ class TerrainGenerator(Session):
                 tile_a = self.latent_field[ia:ia + self.tile_res, ja:ja + self.tile_res]
 
                 # Generate image from tile
-                tile_b = self.gen_b.predict(np.asarray([tile_a]))[0]
+                tile_b = self.infer_b(np.asarray([tile_a]))[0]
                 #tile_b -= np.mean(tile_b[:, :, 1])
                 #tile_b += delta
 
@@ -159,17 +151,56 @@ class TerrainGenerator(Session):
                 jb = int(ja * self.b_scaling)
 
                 if blend:
-                    tile_b *= weight_mask
-                    output[ib:ib + output_tile_res, jb:jb + output_tile_res] += tile_b
-                    overlap_map[ib:ib + output_tile_res, jb:jb + output_tile_res] += weight_mask
+                    output.add([tile_b], [(ib, jb)], weight_mask_b)
                 else:
                     output[ib:ib + output_tile_res, jb:jb + output_tile_res] = tile_b
 
         if blend:
-            output /= overlap_map
+            output = output.result()
 
         return output
 
+    def render_latent_field(self, tile_size=None, halo=4):
+        """
+        Run gen_b once over the whole latent field instead of sliding it over tile_res windows
+        (see process_latent_field), so every latent pixel is rendered once and there are no seams.
+        With tile_size the field is rendered in tiles of tile_size x tile_size latent pixels to
+        bound memory. Each tile is padded with halo latent pixels of its neighbours, which are
+        cropped away again. The receptive field of gen_b spans less than 2 latent pixels with
+        3x3 kernels, so the default halo gives the same output as a single pass.
+        """
+
+        print('Rendering latent field...')
+
+        if tile_size is None:
+            return self.infer_b_field(self.latent_field[np.newaxis])[0]
+
+        height, width = self.latent_field.shape[:2]
+        output = np.zeros(shape=[int(height * self.b_scaling), int(width * self.b_scaling), self.pgg.channels],
+                          dtype=np.float32)
+
+        for y in range(0, height, tile_size):
+            for x in range(0, width, tile_size):
+                self.render_region(self.latent_field, output, y, min(y + tile_size, height),
+                                   x, min(x + tile_size, width), halo)
+
+        return output
+
+    def render_region(self, field, output, y, y_end, x, x_end, halo=4):
+        # Render latent rows y:y_end and columns x:x_end of a field into output, padded with a halo of latent pixels
+
+        # Region with its halo, clipped to the field like the zero padding of a single pass
+        height, width = field.shape[:2]
+        ya, xa = max(y - halo, 0), max(x - halo, 0)
+        tile_a = np.asarray(field[ya:min(y_end + halo, height), xa:min(x_end + halo, width)])
+        tile_b = self.infer_b_field(tile_a[np.newaxis])[0]
+
+        # Crop away the halo
+        ib, jb = int((y - ya) * self.b_scaling), int((x - xa) * self.b_scaling)
+        hb, wb = int((y_end - y) * self.b_scaling), int((x_end - x) * self.b_scaling)
+        output[int(y * self.b_scaling):int(y * self.b_scaling) + hb,
+               int(x * self.b_scaling):int(x * self.b_scaling) + wb] = tile_b[ib:ib + hb, jb:jb + wb]
+
 
 if __name__ == '__main__':
 
@@ -186,7 +217,8 @@ if __name__ == '__main__':
 
     #tg.add_gradient_noise(factor=2)
 
-    out = tg.process_latent_field(stride=4, blend=True)
+    #out = tg.process_latent_field(stride=4, blend=True)
+    out = tg.render_latent_field()
 
     #out[:, :, 1] = combine_channels(out)[:, :, 0]
     #out[:, :, 0] = (out[:, :, 0] + 1.0) / 2.0
@@ -1,13 +1,48 @@
+import os
+import threading
 import matplotlib.pyplot as plt
 
+from collections import OrderedDict
+
 from model import *
 from util import *
 from latent_manipulation import *
+from tile_cache import *
+from tile_store import *
+from inference import *
+from export import *
+from blend import *
+
+
+class RenderLevel(object):
+    """
+    A gen_b ending at end_block, with the geometry used to blend its outputs into tiles.
+    Level 0 is the full generator, each further level stops one block earlier and
+    renders tiles at half the resolution of the previous one.
+    """
+
+    def __init__(self, end_block, gen_b, infer_b, res_a, overlap, offsets_a):
+        self.end_block = end_block
+        self.gen_b = gen_b
+        self.infer_b = infer_b
+        self.res_b = gen_b.outputs[0].shape[1]
+        self.scale_b = self.res_b / res_a
+        self.chunk_size_b = int((res_a * 3 - overlap * 2) * self.scale_b)
+        self.offsets_b = [(int(ya * self.scale_b), int(xa * self.scale_b)) for ya, xa in offsets_a]
+        self.weight_mask_b = weight_mask(self.res_b, 4)
+        self.store = None
+
+        # The center tile with some of the blended overlap trimmed away
+        self.tile_start = int((res_a - overlap / 2) * self.scale_b)
+        self.out_res = int((res_a - overlap) * self.scale_b)
 
 
 class TileGenerator(Session):
 
-    def __init__(self, session_id, segment_idx, overlap=2, steps=None):
+    def __init__(self, session_id, segment_idx, overlap=2, steps=None,
+                 cache_bytes=256 * 2 ** 20, window_cache_bytes=512 * 2 ** 20, jit_compile=False,
+                 fused=False, prefetch=False, prefetch_memory=4096, preview=False, lod_levels=0, store_bytes=0,
+                 shared_windows=False):
 
         # Load session config
         super(TileGenerator, self).__init__(session_id)
@@ -15,6 +50,7 @@ class TileGenerator(Session):
         # Set parameters
         self.segment_idx = segment_idx
         self.overlap = overlap
+        self.shared_windows = shared_windows
 
         # Build progressively-grown gan and get segmented generator
         self.pgg = PGGAN(latent_size=self.config['latent_size'],
@@ -31,108 +67,371 @@ class TileGenerator(Session):
             self.steps = steps
 
         # Load weights into generators
-        version = '{}_{}'.format(self.pgg.n_blocks - 1, self.steps)
-        load_weights(self.gen_a, 'gen', version, self.session_id)
-        load_weights(self.gen_b, 'gen', version, self.session_id)
+        self.version = '{}_{}'.format(self.pgg.n_blocks - 1, self.steps)
+        load_weights(self.gen_a, 'gen', self.version, self.session_id)
+        load_weights(self.gen_b, 'gen', self.version, self.session_id)
+
+        # Cheap low resolution previews straight from gen_a output, using the to_channels head trained for
+        # the block before the split (it is last saved with the final checkpoint of the following block)
+        self.preview_head = None
+        if preview:
+            self.preview_head = self.pgg.build_head(segment_idx - 1)
+            load_weights(self.preview_head, 'gen', self.head_version(segment_idx - 1), self.session_id)
+            self.preview_head = InferenceModel(self.preview_head, jit_compile, warmup_batch_sizes=())
+
+        # Swap in inference-only generators with the equalized learning rate folded into the weights
+        if fused:
+            self.gen_a, self.gen_b = export_inference(self.pgg, self.gen_a, self.gen_b, segment_idx)
+
+        # Compile fixed-signature inference functions (a request runs at most nine tiles per generator)
+        self.infer_a = InferenceModel(self.gen_a, jit_compile, warmup_batch_sizes=(1, 9))
+        self.infer_b = InferenceModel(self.gen_b, jit_compile, warmup_batch_sizes=(1, 9))
 
         # Get some variables from the generators for later use
         self.res_a = self.gen_a.outputs[0].shape[1]
         self.res_b = self.gen_b.outputs[0].shape[1]
         self.scale_b = self.res_b / self.res_a
-        self.latent_tile_map = {}
-
-        # Initialize weight mask for gen_a (used to blend intermediate latent tiles)
-        self.weight_mask_a = np.zeros(shape=(self.res_a, self.res_a, 1))
-        r = (self.res_a - 1.0) / 2.0
-        max_weight = np.linalg.norm(np.asarray([r, r]))
-        for i in range(self.res_a):
-            x = i - r
-            for j in range(self.res_a):
-                y = j - r
-                weight = np.linalg.norm(np.asarray([x, y]))
-                self.weight_mask_a[i, j, 0] = max_weight - weight + 1
-
-        # Initialize weight mask for gen_b (used to blend final tile outputs)
-        self.weight_mask_b = np.zeros(shape=(self.res_b, self.res_b, 1))
-        r = (self.res_b - 1.0) / 2.0
-        max_weight = np.linalg.norm(np.asarray([r, r]))
-        for i in range(self.res_b):
-            x = i - r
-            for j in range(self.res_b):
-                y = j - r
-                weight = np.linalg.norm(np.asarray([x, y]))
-                self.weight_mask_b[i, j, 0] = (max_weight - weight) ** 4 + 1
+        self.latent_tile_cache = TileCache(cache_bytes)
+        self.window_cache = TileCache(window_cache_bytes)
+
+        # Weight masks used to blend intermediate latent tiles and final tile outputs
+        self.weight_mask_a = weight_mask(self.res_a, 1)
+        self.weight_mask_b = weight_mask(self.res_b, 4)
+
+        # Chunk sizes and offsets of the 3x3 tiles within a chunk (row 0 of the grid is at the bottom)
+        self.chunk_size_a = self.res_a * 3 - self.overlap * 2
+        self.chunk_size_b = int(self.chunk_size_a * self.scale_b)
+        self.offsets_a = [((self.res_a - self.overlap) * (2 - i), (self.res_a - self.overlap) * j)
+                          for i in range(3) for j in range(3)]
+        self.offsets_b = [(int(ya * self.scale_b), int(xa * self.scale_b)) for ya, xa in self.offsets_a]
+
+        # Render levels for distant tiles, each gen_b stops one block earlier (see render_windows)
+        lod_levels = min(lod_levels, self.pgg.n_blocks - 1 - segment_idx)
+        self.levels = [RenderLevel(self.pgg.n_blocks - 1, self.gen_b, self.infer_b,
+                                   self.res_a, self.overlap, self.offsets_a)]
+        for lod in range(1, lod_levels + 1):
+            self.levels.append(self.build_level(self.pgg.n_blocks - 1 - lod, jit_compile, fused))
+
+        # Finished tiles of every level also go to disk, invalidated whenever the checkpoint file changes
+        # (only one TileGenerator per session and segment may use the stores at a time)
+        if store_bytes > 0:
+            weights_mtime = os.path.getmtime(root_dir + 'models/{}/gen_{}.h5'.format(self.session_id, self.version))
+            for level in self.levels:
+                path = root_dir + 'tile_store/{}/segment_{}_block_{}/'.format(self.session_id, segment_idx,
+                                                                              level.end_block)
+                version = (self.session_id, self.version, weights_mtime, segment_idx, level.end_block, overlap,
+                           shared_windows)
+                level.store = TileStore(path, (level.out_res, level.out_res, level.gen_b.outputs[0].shape[-1]),
+                                        store_bytes, repr(version))
 
         # Create latent manipulator
-        self.lm = LatentManipulator(session_id, 'msm10')
+        self.lm_version = 'msm10'
+        self.lm_attribute = 'mean_5'
+        self.lm_delta = -1.0
+        self.lm = LatentManipulator(session_id, self.lm_version)
+
+        # Prefetch state: recently seen neighbourhoods and latents by (face, x, y), and cache keys warmed ahead of time
+        self.prefetch_enabled = prefetch
+        self.prefetch_memory = prefetch_memory
+        self.known_requests = OrderedDict()
+        self.known_latents = OrderedDict()
+        self.prefetched = OrderedDict()
+        self.prefetch_count = 0
+        self.prefetch_hits = 0
+        self.prefetch_wasted = 0
+        self.prefetch_lock = threading.Lock()
+
+    def build_level(self, end_block, jit_compile=False, fused=False):
+        # Truncated gen_b: the blocks come from the serving checkpoint, the head from the last checkpoint that trained it
+        _, gen_b = self.pgg.build_gen_stable(self.segment_idx, end_block=end_block)
+        load_weights(gen_b, 'gen', self.version, self.session_id)
+        head = self.pgg.build_head(end_block)
+        load_weights(head, 'gen', self.head_version(end_block), self.session_id)
+        head_name = 'to_channels_{}'.format(end_block)
+        gen_b.get_layer(head_name).set_weights(head.get_layer(head_name).get_weights())
+
+        if fused:
+            _, fused_b = self.pgg.build_gen_stable(self.segment_idx, fused=True, end_block=end_block)
+            fuse_weights(gen_b, fused_b)
+            latents = tf.constant(random_latents(self.pgg.latent_size, 4), dtype=tf.float32)
+            check_equivalence(gen_b, fused_b, self.gen_a(latents, training=False))
+            gen_b = fused_b
+
+        infer_b = InferenceModel(gen_b, jit_compile, warmup_batch_sizes=(1, 9))
+        return RenderLevel(end_block, gen_b, infer_b, self.res_a, self.overlap, self.offsets_a)
+
+    def head_version(self, block):
+        # Checkpoint version holding the latest trained to_channels head of a block
+        if block >= self.pgg.n_blocks - 2:
+            return '{}_{}'.format(self.pgg.n_blocks - 1, self.steps)
+        block_steps = self.config['block_steps']
+        if isinstance(block_steps, int):
+            block_steps = [block_steps] * self.pgg.n_blocks
+        return '{}_{}'.format(block + 1, block_steps[block + 1])
+
+    def request_key(self, request):
+        # Store key of a finished tile: its latents, rotations and missing neighbours, and the manipulation
+        latents, tile_ids, rotations, name = request
+        present = tuple(str(tile_id) != '-1' for tile_id in tile_ids)
+        return array_digest(latents, rotations, params=(self.lm_version, self.lm_attribute, self.lm_delta, present))
+
+    def level_index(self, lod):
+        # Render level of a requested lod, clamped to the levels built
+        return min(max(int(lod), 0), len(self.levels) - 1)
+
+    def latent_key(self, tile_id, latent):
+        # Cache key for an intermediate tile, so a reused tile id never returns a stale tile
+        return str(tile_id), array_digest(latent, params=(self.lm_version, self.lm_attribute, self.lm_delta))
+
+    def cache_get(self, cache, key):
+        value = cache.get(key)
+        if value is not None and self.prefetch_enabled:
+            with self.prefetch_lock:
+                if self.prefetched.pop(key, False):
+                    self.prefetch_hits += 1
+        return value
+
+    def cache_put(self, cache, key, value, prefetch=False):
+        cache.put(key, value)
+        if prefetch:
+            with self.prefetch_lock:
+                self.prefetched[key] = True
+                self.prefetched.move_to_end(key)
+                self.prefetch_count += 1
+
+                # Forget the oldest prefetched keys, they have most likely been evicted unused
+                while len(self.prefetched) > self.prefetch_memory * 18:
+                    self.prefetched.popitem(last=False)
+                    self.prefetch_wasted += 1
 
     def generate_tile(self, latents, tile_ids, rotations, name, save_img=True):
-
-        chunk_size_a = self.res_a * 3 - self.overlap * 2
-
-        chunk_a = np.zeros(shape=(chunk_size_a, chunk_size_a, self.gen_a.outputs[0].shape[-1]))
-        weight_map_a = np.zeros(shape=(chunk_size_a, chunk_size_a, 1))
-
-        tiles = []
-
-        # Lookup intermediate tiles and generate if missing
-        for i in range(9):
-            tile_id = str(tile_ids[i])
-            if tile_id != '-1':
-                try:
-                    tile = self.latent_tile_map[tile_id]
-                except KeyError:
-                    latents[i] = self.lm.center_latent(latents[i], 'mean_5')
-                    latents[i] = self.lm.move_latent(latents[i], 'mean_5', -1.0)
-                    tile = self.gen_a.predict(np.asarray([latents[i]]))[0]
-                    self.latent_tile_map[tile_id] = tile
-                tiles.append(np.rot90(tile, rotations[i], axes=(0, 1)))
-            else:
-                tiles.append(None)
-
-        # Blend intermediate latent tiles together
-        for i in range(3):
-            y = (self.res_a - self.overlap) * (2 - i)
-            for j in range(3):
-                x = (self.res_a - self.overlap) * j
-                if tiles[i * 3 + j] is not None:
-                    chunk_a[y:y + self.res_a, x:x + self.res_a] += tiles[i * 3 + j] * self.weight_mask_a
-                    weight_map_a[y:y + self.res_a, x:x + self.res_a] += self.weight_mask_a
-
-        chunk_a /= weight_map_a + 1e-8
-
-        chunk_size_b = int(chunk_size_a * self.scale_b)
-
-        chunk_b = np.zeros(shape=(chunk_size_b, chunk_size_b, self.gen_b.outputs[0].shape[-1]))
-        weight_map_b = np.zeros(shape=(chunk_size_b, chunk_size_b, 1))
-
-        # Blend tile outputs together
-        for i in range(3):
-            ya = (self.res_a - self.overlap) * (2 - i)
-            yb = int(ya * self.scale_b)
-            for j in range(3):
-                xa = (self.res_a - self.overlap) * j
-                xb = int(xa * self.scale_b)
-
-                tile_b = self.gen_b.predict(np.asarray([np.rot90(chunk_a[ya:ya + self.res_a, xa:xa + self.res_a], -rotations[i * 3 + j], (0, 1))]))[0]
-                tile_b = np.rot90(tile_b, rotations[i * 3 + j], (0, 1))
-                tile_b = (tile_b + 1.0) / 2.0
-
-                chunk_b[yb:yb + self.res_b, xb:xb + self.res_b] += tile_b * self.weight_mask_b
-                weight_map_b[yb:yb + self.res_b, xb:xb + self.res_b] += self.weight_mask_b
-
-        chunk_b /= weight_map_b + 1e-8
-
-        # Slice out the center tile and trim some of the blended overlap to avoid redundancy
-        tile_start = int((self.res_a - self.overlap / 2) * self.scale_b)
-        out_res = int((self.res_a - self.overlap) * self.scale_b)
-        tile_out = chunk_b[tile_start:tile_start + out_res, tile_start:tile_start + out_res]
+        return self.generate_tiles([(latents, tile_ids, rotations, name)], save_img)[0]
+
+    def generate_tiles(self, requests, save_img=True, prefetch=False, lods=None):
+        """
+        Generate a batch of tiles. Each request is a tuple (latents, tile_ids, rotations, name)
+        describing the 3x3 neighbourhood of one tile. All requests share a single gen_a pass and
+        one gen_b pass per render level. lods optionally gives the render level of each request,
+        level k tiles have 1 / 2 ** k of the full resolution. Tiles found in the on-disk stores
+        (see store_bytes) are not generated again.
+        """
+
+        if lods is None:
+            lods = [0] * len(requests)
+        levels = [self.levels[self.level_index(lod)] for lod in lods]
+
+        # Tiles generated before, possibly by an earlier run of the server
+        tiles_out = [None] * len(requests)
+        keys = [None] * len(requests)
+        for r, level in enumerate(levels):
+            if level.store is not None:
+                keys[r] = self.request_key(requests[r])
+                tiles_out[r] = level.store.get(keys[r])
+
+        missing = [r for r in range(len(requests)) if tiles_out[r] is None]
+        if missing:
+            windows = self.latent_windows([requests[r] for r in missing], prefetch)
+            rendered = self.render_windows(windows, [requests[r][2] for r in missing], prefetch,
+                                           [lods[r] for r in missing])
+            for r, tile_out in zip(missing, rendered):
+                tiles_out[r] = tile_out
+                if keys[r] is not None:
+                    levels[r].store.put(keys[r], tile_out)
 
         # Save an image of the output for debugging
         if save_img:
-            save_image(tile_out[:, :, 1], name, 6, 1, 'ue4_comms')
-
-        return tile_out
+            for tile_out, request in zip(tiles_out, requests):
+                save_image(tile_out[:, :, 1], request[3], 6, 1, 'ue4_comms')
+
+        return tiles_out
+
+    def latent_tiles(self, entries, prefetch=False):
+        # Lookup intermediate tiles for a list of (tile_id, latent) pairs and generate the missing ones in one batch
+
+        tiles = [None] * len(entries)
+        missing = {}
+        for n, (tile_id, latent) in enumerate(entries):
+            key = self.latent_key(tile_id, latent)
+            tiles[n] = self.cache_get(self.latent_tile_cache, key)
+            if tiles[n] is None:
+                missing.setdefault(key, []).append(n)
+
+        if missing:
+            batch = np.stack([np.asarray(entries[idx[0]][1]) for idx in missing.values()])
+            batch = self.lm.center_latent(batch, self.lm_attribute)
+            batch = self.lm.move_latent(batch, self.lm_attribute, self.lm_delta)
+            for (key, idx), tile in zip(missing.items(), self.infer_a(batch)):
+                self.cache_put(self.latent_tile_cache, key, tile, prefetch)
+                for n in idx:
+                    tiles[n] = tile
+
+        return tiles
+
+    def latent_windows(self, requests, prefetch=False):
+        """
+        gen_a stage: the nine gen_b windows of every request, each a (key, window) pair or None.
+        By default all nine are cut from the blended latent chunk, exactly as a single tile request
+        renders them, and each is keyed by the latents and rotations of the tiles that blend into it
+        (relative to the window), so only requests with the same neighbourhood share it. With
+        shared_windows the outer windows are the plain gen_a tiles instead, keyed by their latent
+        alone, so neighbouring requests share them at the cost of unblended borders around the center.
+        """
+
+        # Intermediate tiles of all requests share a single gen_a batch
+        slots = [(r, i) for r, request in enumerate(requests) for i in range(9) if str(request[1][i]) != '-1']
+        entries = [(requests[r][1][i], requests[r][0][i]) for r, i in slots]
+        tiles = [[None] * 9 for _ in requests]
+        for (r, i), tile in zip(slots, self.latent_tiles(entries, prefetch)):
+            tiles[r][i] = tile
+
+        windows = []
+        for r, (latents, tile_ids, rotations, name) in enumerate(requests):
+            present = [i for i in range(9) if tiles[r][i] is not None]
+            keys = [self.latent_key(tile_ids[i], latents[i]) if i in present else None for i in range(9)]
+
+            # Blend intermediate latent tiles together
+            chunk_a = OverlapAdd(self.chunk_size_a, self.chunk_size_a, self.gen_a.outputs[0].shape[-1])
+            chunk_a.add([np.rot90(tiles[r][i], rotations[i], axes=(0, 1)) for i in present],
+                        [self.offsets_a[i] for i in present], self.weight_mask_a)
+            chunk_a = chunk_a.result()
+
+            # Slice the windows out of the latent chunk and rotate them into their own orientation
+            request_windows = []
+            for k, (ya, xa) in enumerate(self.offsets_a):
+                window = np.rot90(chunk_a[ya:ya + self.res_a, xa:xa + self.res_a], -rotations[k], (0, 1))
+                inputs = tuple((i // 3 - k // 3, i % 3 - k % 3, keys[i], int(rotations[i]))
+                               for i in present if self.blends_into(i, k))
+                request_windows.append((('chunk', int(rotations[k]), inputs), window))
+
+            if self.shared_windows:
+                for k in range(9):
+                    if k != 4:
+                        request_windows[k] = (('tile', keys[k]), tiles[r][k]) if k in present else None
+            windows.append(request_windows)
+
+        return windows
+
+    def blends_into(self, i, k):
+        # Whether chunk tile i overlaps window k, i.e. contributes to its blended latents
+        stride = self.res_a - self.overlap
+        return abs(i // 3 - k // 3) * stride < self.res_a and abs(i % 3 - k % 3) * stride < self.res_a
+
+    def render_windows(self, windows, rotations, prefetch=False, lods=None):
+        # gen_b stage: render the windows of each request at its level of detail (clamped to the levels built)
+        if lods is None:
+            lods = [0] * len(windows)
+        lods = [self.level_index(lod) for lod in lods]
+
+        tiles_out = [None] * len(windows)
+        for lod in sorted(set(lods)):
+            group = [r for r in range(len(windows)) if lods[r] == lod]
+            level_tiles = self.render_level(self.levels[lod],
+                                            [windows[r] for r in group],
+                                            [rotations[r] for r in group],
+                                            prefetch)
+            for r, tile_out in zip(group, level_tiles):
+                tiles_out[r] = tile_out
+
+        return tiles_out
+
+    def render_level(self, level, windows, rotations, prefetch=False):
+        # Render the windows of every request with one gen_b and blend them into output tiles
+
+        # Lookup generated windows by the keys of their gen_a inputs and collect the missing ones
+        tiles_b = [[None] * 9 for _ in windows]
+        missing = {}
+        for r in range(len(windows)):
+            for k, window in enumerate(windows[r]):
+                if window is None:
+                    continue
+                key = (level.end_block,) + window[0]
+                tiles_b[r][k] = self.cache_get(self.window_cache, key)
+                if tiles_b[r][k] is None:
+                    missing.setdefault(key, []).append((r, k))
+
+        # Generate all missing tile outputs in a single batch
+        if missing:
+            batch = np.stack([windows[r][k][1] for r, k in [idx[0] for idx in missing.values()]])
+            for (key, idx), tile_b in zip(missing.items(), level.infer_b(batch)):
+                self.cache_put(self.window_cache, key, tile_b, prefetch)
+                for r, k in idx:
+                    tiles_b[r][k] = tile_b
+
+        tiles_out = []
+        for r in range(len(windows)):
+
+            # Undo the rotations and blend tile outputs together
+            present = [k for k in range(9) if tiles_b[r][k] is not None]
+            tiles = np.stack([np.rot90(tiles_b[r][k], rotations[r][k], (0, 1)) for k in present])
+            chunk_b = OverlapAdd(level.chunk_size_b, level.chunk_size_b, level.gen_b.outputs[0].shape[-1])
+            chunk_b.add((tiles + 1.0) / 2.0, [level.offsets_b[k] for k in present], level.weight_mask_b)
+            chunk_b = chunk_b.result()
+
+            # Slice out the center tile and trim some of the blended overlap to avoid redundancy
+            tiles_out.append(chunk_b[level.tile_start:level.tile_start + level.out_res,
+                                     level.tile_start:level.tile_start + level.out_res])
+
+        return tiles_out
+
+    def preview_tiles(self, requests, windows):
+        # Low resolution preview of each tile from its blended latent chunk, without running gen_b
+        start = self.overlap // 2
+        size = self.res_a - self.overlap
+        centers = [np.rot90(w[4][1], request[2][4], (0, 1))[start:start + size, start:start + size]
+                   for request, w in zip(requests, windows)]
+        return list((self.preview_head(np.stack(centers)) + 1.0) / 2.0)
+
+    def remember(self, coords, request):
+        # Record a request and the latents it carries under their (face, x, y) coordinates for prefetching
+        if not self.prefetch_enabled:
+            return
+        latents, tile_ids, rotations, name = request
+        with self.prefetch_lock:
+            self.known_requests[tuple(coords[4])] = request
+            self.known_requests.move_to_end(tuple(coords[4]))
+            for i in range(9):
+                if str(tile_ids[i]) != '-1':
+                    self.known_latents[tuple(coords[i])] = (tile_ids[i], latents[i])
+                    self.known_latents.move_to_end(tuple(coords[i]))
+            while len(self.known_requests) > self.prefetch_memory:
+                self.known_requests.popitem(last=False)
+            while len(self.known_latents) > self.prefetch_memory * 9:
+                self.known_latents.popitem(last=False)
+
+    def predict_ring(self, face, position, velocity, lookahead=1.0, radius=1):
+        # Tiles around where the viewer will be after lookahead seconds (position in tiles, velocity in tiles/s)
+        x = int(round(position[0] + velocity[0] * lookahead))
+        y = int(round(position[1] + velocity[1] * lookahead))
+        ring = [(face, x + dx, y + dy) for dy in range(-radius, radius + 1) for dx in range(-radius, radius + 1)]
+
+        # Nearest tiles first
+        return sorted(ring, key=lambda c: (c[1] - x) ** 2 + (c[2] - y) ** 2)
+
+    def prefetch_tile(self, coord):
+        # Warm both caches for a full neighbourhood seen before, or just the gen_a cache for a known latent
+        with self.prefetch_lock:
+            request = self.known_requests.get(tuple(coord))
+            latent = self.known_latents.get(tuple(coord))
+
+        if request is not None:
+            self.generate_tiles([request], save_img=False, prefetch=True)
+        elif latent is not None:
+            self.latent_tiles([latent], prefetch=True)
+
+    def store_stats(self):
+        return {level.end_block: level.store.stats() for level in self.levels if level.store is not None}
+
+    def flush(self):
+        for level in self.levels:
+            if level.store is not None:
+                level.store.flush()
+
+    def prefetch_stats(self):
+        with self.prefetch_lock:
+            return {'prefetched': self.prefetch_count,
+                    'hits': self.prefetch_hits,
+                    'wasted': self.prefetch_wasted,
+                    'hit_rate': self.prefetch_hits / self.prefetch_count if self.prefetch_count > 0 else 0.0}
 
 
 # Some stuff left over from debugging
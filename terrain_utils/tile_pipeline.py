@@ -0,0 +1,135 @@
+import time
+import queue
+import threading
+
+from concurrent.futures import Future
+
+
+class PipelineStage(object):
+    """
+    Worker threads running one stage of the pipeline. Each worker takes the next item and
+    greedily merges up to max_batch queued items into one call of fn, which maps a list of
+    requests to a list of results.
+    """
+
+    def __init__(self, name, fn, n_workers, max_batch, output=None):
+
+        self.name = name
+        self.fn = fn
+        self.max_batch = max_batch
+        self.output = output
+        self.inputs = queue.Queue()
+        self.lock = threading.Lock()
+
+        # Counters
+        self.n_workers = n_workers
+        self.started = time.perf_counter()
+        self.busy = 0.0
+        self.calls = 0
+        self.items = 0
+
+        self.workers = []
+        for i in range(n_workers):
+            t = threading.Thread(target=self._work, name='{}_{}'.format(name, i), daemon=True)
+            t.start()
+            self.workers.append(t)
+
+    def put(self, item):
+        self.inputs.put(item)
+
+    def _work(self):
+        while True:
+            items = [self.inputs.get()]
+            if items[0] is None:
+                # Pass the sentinel on so every worker stops
+                self.inputs.put(None)
+                return
+            while len(items) < self.max_batch:
+                try:
+                    item = self.inputs.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Leave the sentinel for the next worker
+                    self.inputs.put(None)
+                    break
+                items.append(item)
+
+            # Items are (future, requests, state), all requests of all items go through one call
+            requests = [request for _, item_requests, _ in items for request in item_requests]
+            states = [state for _, item_requests, item_states in items for state in item_states]
+
+            start = time.perf_counter()
+            try:
+                results = self.fn(requests, states)
+            except BaseException as e:
+                for future, _, _ in items:
+                    future.set_exception(e)
+                continue
+            finally:
+                with self.lock:
+                    self.busy += time.perf_counter() - start
+                    self.calls += 1
+                    self.items += len(items)
+
+            # Hand each item its share of the results
+            n = 0
+            for future, item_requests, _ in items:
+                item_results = results[n:n + len(item_requests)]
+                n += len(item_requests)
+                if self.output is not None:
+                    self.output.put((future, item_requests, item_results))
+                else:
+                    future.set_result(item_results)
+
+    def stop(self):
+        self.inputs.put(None)
+        for t in self.workers:
+            t.join()
+
+    def stats(self):
+        with self.lock:
+            elapsed = time.perf_counter() - self.started
+            return {'workers': self.n_workers,
+                    'queue_depth': self.inputs.qsize(),
+                    'calls': self.calls,
+                    'mean_batch': self.items / self.calls if self.calls > 0 else 0.0,
+                    'busy': self.busy,
+                    'utilisation': self.busy / (elapsed * self.n_workers) if elapsed > 0 else 0.0}
+
+
+class TilePipeline(object):
+    """
+    Two-stage tile engine on top of a TileGenerator. Stage a builds latent windows with gen_a,
+    stage b renders them with gen_b, so gen_a for one request runs while gen_b renders another.
+    Per-stage utilisation shows which half of the split generator is the bottleneck.
+    """
+
+    def __init__(self, tg, a_workers=1, b_workers=1, max_batch=8):
+
+        self.tg = tg
+        self.stage_b = PipelineStage('gen_b', self._render, b_workers, max_batch)
+        self.stage_a = PipelineStage('gen_a', self._windows, a_workers, max_batch, output=self.stage_b)
+
+    def _windows(self, requests, states):
+        return self.tg.latent_windows(requests)
+
+    def _render(self, requests, windows):
+        return self.tg.render_windows(windows, [request[2] for request in requests])
+
+    def submit(self, requests):
+        # Queue a list of (latents, tile_ids, rotations, name) requests, returns a Future of their tiles
+        future = Future()
+        self.stage_a.put((future, requests, [None] * len(requests)))
+        return future
+
+    def generate_tiles(self, requests):
+        return self.submit(requests).result()
+
+    def stats(self):
+        return {'gen_a': self.stage_a.stats(),
+                'gen_b': self.stage_b.stats()}
+
+    def close(self):
+        self.stage_a.stop()
+        self.stage_b.stop()
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import atexit
+import hashlib
+import threading
+
+import numpy as np
+
+
+class TileStore(object):
+    """
+    Persistent tile cache in a directory of memory-mapped files that survives server restarts.
+    Tiles of one fixed shape are float32 records in tiles.dat, index.dat holds the 16-byte key,
+    the last use and a checksum of every record. Opening a store only scans the index and a hit
+    is a copy out of the page cache. meta.json records the version the tiles were generated with,
+    a store opened with a different version or record shape starts empty. Keys are hex digests
+    (see array_digest), the least recently used record is overwritten once the store is full.
+    Dirty pages are written out every flush_seconds and at exit. A record that was torn by a
+    crash before that fails its checksum on the next read and is dropped.
+    """
+
+    index_dtype = np.dtype([('key', 'u1', (16,)), ('used', '<i8'), ('checksum', 'u1', (8,))])
+    format_version = 2
+
+    def __init__(self, path, record_shape, max_bytes=2 * 2 ** 30, version='', flush_seconds=60.0):
+
+        self.path = path
+        self.record_shape = tuple(int(n) for n in record_shape)
+        self.max_records = max(1, int(max_bytes // (int(np.prod(self.record_shape)) * 4)))
+        self.lock = threading.Lock()
+        self.flush_seconds = flush_seconds
+        self.flushed = time.perf_counter()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.corrupt = 0
+
+        # Start over if the tiles were generated by another model version or the files are missing
+        meta = {'format': self.format_version, 'version': str(version), 'record_shape': list(self.record_shape),
+                'max_records': self.max_records}
+        meta_path = os.path.join(path, 'meta.json')
+        index_path = os.path.join(path, 'index.dat')
+        tiles_path = os.path.join(path, 'tiles.dat')
+        fresh = True
+        if os.path.exists(meta_path) and os.path.exists(index_path) and os.path.exists(tiles_path):
+            with open(meta_path) as f:
+                fresh = json.load(f) != meta
+
+        os.makedirs(path, exist_ok=True)
+        mode = 'w+' if fresh else 'r+'
+        self.index = np.memmap(index_path, dtype=self.index_dtype, mode=mode, shape=(self.max_records,))
+        self.records = np.memmap(tiles_path, dtype=np.float32, mode=mode,
+                                 shape=(self.max_records,) + self.record_shape)
+        if fresh:
+            self.index.flush()
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+
+        # Records in use have a nonzero last use
+        used = self.index['used']
+        self.slots = {bytes(self.index['key'][slot]): int(slot) for slot in np.flatnonzero(used)}
+        self.free = [int(slot) for slot in np.flatnonzero(used == 0)[::-1]]
+        self.clock = int(used.max())
+        atexit.register(self.flush)
+
+    @staticmethod
+    def checksum(record):
+        return np.frombuffer(hashlib.blake2b(np.ascontiguousarray(record, dtype=np.float32).tobytes(),
+                                             digest_size=8).digest(), dtype=np.uint8)
+
+    def get(self, key):
+        key = bytes.fromhex(key)
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None:
+                self.misses += 1
+                return None
+            record = np.array(self.records[slot])
+
+            # A record torn by a crash is dropped
+            if not np.array_equal(self.checksum(record), self.index['checksum'][slot]):
+                del self.slots[key]
+                self.index['used'][slot] = 0
+                self.free.append(slot)
+                self.corrupt += 1
+                self.misses += 1
+                return None
+
+            self.clock += 1
+            self.index['used'][slot] = self.clock
+            self.hits += 1
+            return record
+
+    def put(self, key, value):
+        if tuple(value.shape) != self.record_shape:
+            return
+        key = bytes.fromhex(key)
+        with self.lock:
+            if key in self.slots:
+                return
+
+            # Take a free record or overwrite the least recently used one
+            if self.free:
+                slot = self.free.pop()
+            else:
+                slot = int(np.argmin(self.index['used']))
+                del self.slots[bytes(self.index['key'][slot])]
+                self.evictions += 1
+
+            # The checksum in the index entry tells whether the record made it to disk in full
+            self.records[slot] = value
+            self.clock += 1
+            self.index['key'][slot] = np.frombuffer(key, dtype=np.uint8)
+            self.index['used'][slot] = self.clock
+            self.index['checksum'][slot] = self.checksum(value)
+            self.slots[key] = slot
+
+            if time.perf_counter() - self.flushed >= self.flush_seconds:
+                self.write_out()
+
+    def write_out(self):
+        # Records first, so an index entry on disk mostly points at a complete record
+        self.records.flush()
+        self.index.flush()
+        self.flushed = time.perf_counter()
+
+    def flush(self):
+        with self.lock:
+            self.write_out()
+
+    def clear(self):
+        with self.lock:
+            self.index['used'][:] = 0
+            self.index.flush()
+            self.slots.clear()
+            self.free = list(range(self.max_records - 1, -1, -1))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.slots),
+                    'max_entries': self.max_records,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'corrupt': self.corrupt,
+                    'hit_rate': self.hits / lookups if lookups > 0 else 0.0}
+
+    def __contains__(self, key):
+        with self.lock:
+            return bytes.fromhex(key) in self.slots
+
+    def __len__(self):
+        with self.lock:
+            return len(self.slots)
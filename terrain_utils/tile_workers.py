@@ -0,0 +1,262 @@
+import os
+import time
+import queue
+import itertools
+import threading
+import traceback
+import multiprocessing as mp
+
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from util import *
+
+
+def _worker_main(index, cores, intra_op_threads, inter_op_threads, session_id, segment_idx, generator_kwargs,
+                 ring_slots, slot_free, jobs, results):
+
+    # Pin this process to its slice of cores before TensorFlow creates its thread pools
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+    from tile_generator import TileGenerator
+
+    try:
+        tg = TileGenerator(session_id, segment_idx, **generator_kwargs)
+        out_res = int((tg.res_a - tg.overlap) * tg.scale_b)
+        slot_shape = (out_res, out_res, tg.gen_b.outputs[0].shape[-1])
+    except BaseException:
+        results.put(('failed', index, traceback.format_exc()))
+        return
+
+    # The server owns the ring buffer, it sends its name once it knows the tile shape
+    results.put(('ready', index, slot_shape))
+    ring = shared_memory.SharedMemory(name=jobs.get())
+    slots = np.ndarray((ring_slots,) + slot_shape, dtype=np.float32, buffer=ring.buf)
+
+    next_slot = 0
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, requests = job
+
+        try:
+            tiles_out = tg.generate_tiles(requests, save_img=False)
+        except BaseException:
+            results.put(('error', index, (job_id, traceback.format_exc())))
+            continue
+
+        # Write each tile into the next free slot of the ring, the server copies it out and frees the slot
+        used = []
+        for tile_out in tiles_out:
+            slot_free.acquire()
+            slots[next_slot] = tile_out
+            used.append(next_slot)
+            next_slot = (next_slot + 1) % ring_slots
+        results.put(('done', index, (job_id, used)))
+
+    del slots
+    ring.close()
+
+
+class TileWorkerPool(Session):
+    """
+    Runs TileGenerators in separate processes, each pinned to its own slice of cores with
+    its own TensorFlow thread pools. Tiles come back through a shared memory ring buffer per
+    worker instead of being pickled. generate_tiles can be called from any thread. Every
+    poll_seconds the pool checks that its workers are alive, the requests of a worker that
+    died fail with a RuntimeError and it gets no new ones.
+    """
+
+    def __init__(self, session_id, segment_idx, n_workers=None, generator_kwargs=None,
+                 ring_slots=16, inter_op_threads=1, poll_seconds=1.0):
+
+        super(TileWorkerPool, self).__init__(session_id)
+
+        if hasattr(os, 'sched_getaffinity'):
+            cores = sorted(os.sched_getaffinity(0))
+        else:
+            cores = list(range(os.cpu_count()))
+        if n_workers is None:
+            n_workers = max(1, len(cores) // 4)
+        n_workers = min(n_workers, len(cores))
+
+        self.n_workers = n_workers
+        self.ring_slots = ring_slots
+        self.poll_seconds = poll_seconds
+        self.job_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.outstanding = [0] * n_workers
+        self.completed = [0] * n_workers
+        self.dead = [False] * n_workers
+
+        # TensorFlow does not survive fork, so workers are always spawned
+        ctx = mp.get_context('spawn')
+        self.results = ctx.Queue()
+        self.jobs = []
+        self.slot_free = []
+        self.processes = []
+        self.rings = [None] * n_workers
+        self.slots = [None] * n_workers
+        try:
+            for i in range(n_workers):
+                worker_cores = cores[i * len(cores) // n_workers:(i + 1) * len(cores) // n_workers]
+                jobs = ctx.Queue()
+                slot_free = ctx.Semaphore(ring_slots)
+                p = ctx.Process(target=_worker_main,
+                                args=(i, worker_cores, len(worker_cores), inter_op_threads, session_id, segment_idx,
+                                      generator_kwargs or {}, ring_slots, slot_free, jobs, self.results),
+                                daemon=True)
+                p.start()
+                self.jobs.append(jobs)
+                self.slot_free.append(slot_free)
+                self.processes.append(p)
+
+            # Wait for every worker to build its generator and ring buffer
+            for _ in range(n_workers):
+                status, index, slot_shape = self.startup_message()
+                if status != 'ready':
+                    raise RuntimeError('tile worker {} failed to start:\n{}'.format(index, slot_shape))
+                self.rings[index] = shared_memory.SharedMemory(create=True,
+                                                               size=ring_slots * int(np.prod(slot_shape)) * 4)
+                self.slots[index] = np.ndarray((ring_slots,) + tuple(slot_shape), dtype=np.float32,
+                                               buffer=self.rings[index].buf)
+                self.jobs[index].put(self.rings[index].name)
+        except BaseException:
+            # Don't leave workers running or shared memory behind
+            for p in self.processes:
+                p.terminate()
+            for p in self.processes:
+                p.join()
+            self.release_rings()
+            raise
+
+        self.collector = threading.Thread(target=self._collect, name='tile_worker_collector', daemon=True)
+        self.collector.start()
+
+    def startup_message(self):
+        # Next message of a starting worker, a worker that died without sending one fails the startup
+        while True:
+            try:
+                return self.results.get(timeout=self.poll_seconds)
+            except queue.Empty:
+                for index, p in enumerate(self.processes):
+                    if not p.is_alive():
+                        return 'failed', index, 'worker process exited with code {}'.format(p.exitcode)
+
+    def submit(self, requests):
+        # Queue a batch of tile requests on the least busy live worker, returns a Future of the list of tiles
+        future = Future()
+        with self.lock:
+            live = [i for i in range(self.n_workers) if not self.dead[i]]
+            if not live:
+                raise RuntimeError('all tile workers have died')
+            index = min(live, key=lambda i: self.outstanding[i])
+            self.outstanding[index] += 1
+
+            # A job may not need more slots than the ring has
+            job_ids = []
+            for i in range(0, len(requests), self.ring_slots):
+                job_id = next(self.job_ids)
+                job_ids.append(job_id)
+                self.pending[job_id] = [future, None, index]
+            future.job_ids = job_ids
+
+        for job_id, i in zip(job_ids, range(0, len(requests), self.ring_slots)):
+            self.jobs[index].put((job_id, requests[i:i + self.ring_slots]))
+        return future
+
+    def generate_tiles(self, requests):
+        return self.submit(requests).result()
+
+    def _collect(self):
+        checked = time.perf_counter()
+        while True:
+            # Check on the workers at least every poll_seconds, even while others keep sending results
+            try:
+                message = self.results.get(timeout=self.poll_seconds)
+            except queue.Empty:
+                message = ()
+            if time.perf_counter() - checked >= self.poll_seconds:
+                self.check_workers()
+                checked = time.perf_counter()
+            if message is None:
+                return
+            if message == ():
+                continue
+            status, index, (job_id, data) = message
+
+            if status == 'done':
+                # Copy the tiles out of the ring and hand the slots back to the worker
+                result = [self.slots[index][slot].copy() for slot in data]
+                for _ in data:
+                    self.slot_free[index].release()
+            else:
+                result = RuntimeError('tile worker {} failed:\n{}'.format(index, data))
+
+            self.finish_job(job_id, result)
+
+    def finish_job(self, job_id, result):
+        # Record the tiles or error of a job, the future resolves once all jobs of its batch are in
+        with self.lock:
+            if job_id not in self.pending:
+                return
+            future, _, index = self.pending[job_id]
+            self.pending[job_id][1] = result
+            parts = [self.pending[i][1] for i in future.job_ids]
+            if any(part is None for part in parts):
+                return
+            for i in future.job_ids:
+                del self.pending[i]
+            self.outstanding[index] -= 1
+            self.completed[index] += 1
+
+        errors = [part for part in parts if isinstance(part, BaseException)]
+        if errors:
+            future.set_exception(errors[0])
+        else:
+            future.set_result([tile for part in parts for tile in part])
+
+    def check_workers(self):
+        # Fail the jobs of workers that died (OOM, TensorFlow crash), their results will never come
+        for index, p in enumerate(self.processes):
+            if self.dead[index] or p.is_alive():
+                continue
+            with self.lock:
+                self.dead[index] = True
+                lost = [job_id for job_id, (_, _, worker) in self.pending.items() if worker == index]
+            error = RuntimeError('tile worker {} died with exit code {}'.format(index, p.exitcode))
+            for job_id in lost:
+                self.finish_job(job_id, error)
+
+    def stats(self):
+        with self.lock:
+            return {'workers': self.n_workers,
+                    'dead': [i for i in range(self.n_workers) if self.dead[i]],
+                    'outstanding': list(self.outstanding),
+                    'completed': list(self.completed)}
+
+    def close(self):
+        for jobs in self.jobs:
+            jobs.put(None)
+        for p in self.processes:
+            p.join()
+        self.results.put(None)
+        self.collector.join()
+        self.release_rings()
+
+    def release_rings(self):
+        self.slots = None
+        for ring in self.rings:
+            if ring is not None:
+                ring.close()
+                ring.unlink()
+        self.rings = []